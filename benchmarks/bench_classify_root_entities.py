@@ -0,0 +1,111 @@
+"""
+Memory and time of annotate_nice_flowcells followed by classify_root_entities,
+against the implementation before Flowcell/Sample/Participant were slotted and samples were built from columns,
+on a synthetic annotated root table of (by default) 100k flowcells.
+
+The pre-change tree is extracted with `git archive` from the given revision into a temporary directory;
+each implementation then runs in its own fresh process, so that neither's memory use pollutes the other's.
+Python allocations are tracked with tracemalloc: the peaks while annotating and while classifying,
+and what the results retain afterwards. Timings include tracemalloc's overhead.
+Fails if the two implementations classify the flowcells differently.
+
+Usage, from the root of the repository (a git checkout):
+    python benchmarks/bench_classify_root_entities.py [--flowcells 100000] [--baseline-rev 603b6f5^]
+"""
+import argparse
+import gc
+import inspect
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_REV = '603b6f5^'  # parent of the commit slotting Flowcell/Sample/Participant
+
+
+def synthetic_root_table(flowcells: int):
+    """Flowcells of ~flowcells/5 participants, with descriptions following the naming schema"""
+    import pandas as pd
+
+    rng = random.Random(1)
+    rows = [(f"6061-SL-{i:06d}",
+             'CCS',
+             f"T{rng.randint(1, max(1, flowcells // 5))}_2020"
+             f"_{rng.choice(['Autogen', 'Chemagen'])}_{rng.choice(['WBC', 'Saliva', 'WholeBlood'])}")
+            for i in range(flowcells)]
+    return pd.DataFrame(rows, columns=['entity:flowcell_id', 'tech', 'description'])
+
+
+def run_one(tree: str, flowcells: int) -> dict:
+    sys.path.insert(0, tree)
+    from src.terra.expt_design import upload_init_tables_from_local as intake
+
+    table = synthetic_root_table(flowcells)
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    annotations, fc_uuid_2_fc_obj = intake.annotate_nice_flowcells(table, 'description')
+    annotations = annotations.rename(columns={'uuid': 'entity:flowcell_id'})
+    annotate_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.reset_peak()
+    if 'fc_uuid_2_fc_obj' in inspect.signature(intake.classify_root_entities).parameters:
+        classified = intake.classify_root_entities(annotations, fc_uuid_2_fc_obj)
+    else:
+        classified = intake.classify_root_entities(annotations)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    flattened = sorted((level, classifier, value, s.parti_uuid, tuple(sorted(s.flowcells_uuid)))
+                       for level, by_classifier in classified.items()
+                       for classifier, by_value in by_classifier.items()
+                       for value, samples in by_value.items()
+                       for s in samples)
+    return {'seconds': elapsed,
+            'annotate_peak_mib': annotate_peak / 2 ** 20, 'classify_peak_mib': peak / 2 ** 20,
+            'retained_mib': retained / 2 ** 20,
+            'max_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,  # in KiB on Linux
+            'samples': len(flattened),
+            'checksum': hash(json.dumps(flattened)) & 0xFFFFFFFF}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--flowcells', type=int, default=100_000)
+    parser.add_argument('--baseline-rev', default=BASELINE_REV)
+    parser.add_argument('--tree', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.tree:
+        print(json.dumps(run_one(args.tree, args.flowcells)))
+        return
+
+    results = dict()
+    with tempfile.TemporaryDirectory() as baseline_tree:
+        archive = subprocess.run(['git', 'archive', args.baseline_rev, 'src'],
+                                 cwd=REPO_ROOT, check=True, capture_output=True).stdout
+        subprocess.run(['tar', '-x', '-C', baseline_tree], input=archive, check=True)
+        for name, tree in [('baseline', baseline_tree), ('current', REPO_ROOT)]:
+            out = subprocess.run([sys.executable, __file__, '--tree', tree, '--flowcells', str(args.flowcells)],
+                                 check=True, capture_output=True, text=True,
+                                 env=dict(os.environ, PYTHONHASHSEED='0')).stdout
+            results[name] = json.loads(out.strip().splitlines()[-1])
+
+    print(f"annotate_nice_flowcells + classify_root_entities on {args.flowcells} flowcells:")
+    for name, r in results.items():
+        print(f"  {name:>8}: {r['seconds']:.2f}s, tracemalloc peak {r['annotate_peak_mib']:.0f} MiB annotating,"
+              f" {r['classify_peak_mib']:.0f} MiB classifying, retained {r['retained_mib']:.0f} MiB,"
+              f" max RSS {r['max_rss_mib']:.0f} MiB, {r['samples']} samples")
+    if results['baseline']['checksum'] != results['current']['checksum']:
+        sys.exit("The two implementations classify the flowcells differently.")
+
+
+if __name__ == '__main__':
+    main()
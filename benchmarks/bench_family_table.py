@@ -0,0 +1,93 @@
+"""
+Time of construct_bare_family_table_from_individual_table, against the groupby().agg(lambda ...) implementation
+it replaced, on a synthetic root table of (by default) 100k flowcells,
+including individuals without an ID and relations left blank.
+
+Fails if the two implementations' outputs differ (columns, order, values and missing values alike),
+or if the long membership table doesn't hold the same flowcells per individual.
+
+Usage, from the root of the repository:
+    python benchmarks/bench_family_table.py [--flowcells 100000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+
+from src.terra.expt_design.upload_init_tables_from_local import construct_bare_family_table_from_individual_table
+
+
+def baseline_construct_bare_family_table_from_individual_table(individual_fc_table: pd.DataFrame,
+                                                               flowcell_id_col: str,
+                                                               group_by: str,
+                                                               family_id_col: str,
+                                                               relation_col: str) -> pd.DataFrame:
+    """construct_bare_family_table_from_individual_table as it was before being vectorized"""
+    multi_fc_individual_table = individual_fc_table\
+        .groupby(group_by)\
+        .agg({group_by: lambda x: x.tolist()[0],
+              flowcell_id_col: lambda x: x.tolist(),
+              family_id_col: lambda x: x.tolist()[0],
+              relation_col: lambda x: x.tolist()[0]})\
+        .reset_index(drop=True)
+
+    return multi_fc_individual_table
+
+
+def synthetic_individual_table(flowcells: int) -> pd.DataFrame:
+    rng = random.Random(0)
+    individuals = [f'I{rng.randint(0, max(1, flowcells // 3)):06d}' for _ in range(flowcells)]
+    table = pd.DataFrame({'entity:flowcell_id': [f'fc{i}' for i in range(flowcells)],
+                          'individual': individuals,
+                          'family': [f'F{int(i[1:]) % max(1, flowcells // 10)}' for i in individuals],
+                          'relation': [rng.choice(['mother', 'father', 'proband', None]) for _ in range(flowcells)]})
+    table.loc[table.sample(frac=0.01, random_state=1).index, 'individual'] = None
+    return table
+
+
+def _comparable(table: pd.DataFrame) -> pd.DataFrame:
+    """same missing value everywhere, so that frames differing only in NaN vs None compare equal"""
+    table = table.astype(object)
+    return table.where(table.notna(), None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--flowcells', type=int, default=100_000)
+    args = parser.parse_args()
+
+    table = synthetic_individual_table(args.flowcells)
+    columns = ('entity:flowcell_id', 'individual', 'family', 'relation')
+
+    start = time.perf_counter()
+    expected = baseline_construct_bare_family_table_from_individual_table(table, *columns)
+    baseline_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = construct_bare_family_table_from_individual_table(table, *columns)
+    current_seconds = time.perf_counter() - start
+
+    families, membership = construct_bare_family_table_from_individual_table(table, *columns,
+                                                                             membership_as_long_table=True)
+
+    print(f"construct_bare_family_table_from_individual_table on {args.flowcells} flowcells"
+          f" ({len(expected)} individuals):")
+    print(f"  baseline: {baseline_seconds:.2f}s")
+    print(f"   current: {current_seconds:.2f}s")
+
+    if list(expected.columns) != list(actual.columns) or not _comparable(expected).equals(_comparable(actual)):
+        sys.exit("Outputs of the two implementations differ.")
+    members = membership.groupby('individual', sort=True)['entity:flowcell_id'].agg(list)
+    if members.tolist() != expected['entity:flowcell_id'].tolist() \
+            or families['individual'].tolist() != expected['individual'].tolist():
+        sys.exit("The long membership table doesn't match the baseline's flowcells per individual.")
+    print("Outputs are identical.")
+
+
+if __name__ == '__main__':
+    main()
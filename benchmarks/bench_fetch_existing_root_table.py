@@ -0,0 +1,124 @@
+"""
+Peak RSS and time of fetch_existing_root_table, against the implementation it replaced,
+on a synthetic payload of (by default) 100k entities, with Terra mocked out.
+
+The payload is written to a temporary JSON file once; each implementation then runs in its own fresh process,
+holding only the raw payload text before the call, so that peak RSS isn't polluted by building the payload,
+or by the other implementation.
+
+Usage, from the root of the repository:
+    python benchmarks/bench_fetch_existing_root_table.py [--rows 100000] [--columns 20]
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+IMPLEMENTATIONS = ['baseline', 'current']
+
+
+def synthetic_entities(rows: int, columns: int) -> list:
+    """Root-level entities, with string, sparse int, float and boolean attributes."""
+    rng = random.Random(42)
+    entities = list()
+    for i in range(rows):
+        attributes = dict()
+        for c in range(columns):
+            kind = c % 4
+            if 0 == kind:
+                attributes[f'str_{c}'] = f'gs://bucket/sample_{i}/file_{c}.bam'
+            elif 1 == kind:
+                if rng.random() < 0.9:  # sparse, so that pandas infers float64
+                    attributes[f'int_{c}'] = rng.randint(0, 10 ** 6)
+            elif 2 == kind:
+                attributes[f'float_{c}'] = rng.random()
+            else:
+                attributes[f'bool_{c}'] = rng.random() < 0.5
+        entities.append({'name': f'fc_{i}', 'entityType': 'flowcell', 'attributes': attributes})
+    return entities
+
+
+class _FakeResponse:
+    ok = True
+    status_code = 200
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def baseline_fetch_existing_root_table(ns: str, ws: str, etype: str):
+    """fetch_existing_root_table as it was before responses were parsed once and the deep copy was dropped"""
+    import pandas as pd
+    from firecloud import api as fapi
+
+    response = fapi.get_entities(ns, ws, etype=etype)
+    entities = [e.get('name') for e in response.json()]
+    entity_type = [e.get('entityType') for e in response.json()][0]
+    attributes = pd.DataFrame.from_dict([e.get('attributes') for e in response.json()]).sort_index(axis=1).astype('str')
+    attributes.insert(0, column=entity_type, value=entities)
+    return attributes.copy(deep=True)
+
+
+def run_one(implementation: str, payload_file: str) -> dict:
+    from src.terra import table_utils
+
+    fetch = baseline_fetch_existing_root_table if 'baseline' == implementation \
+        else table_utils.fetch_existing_root_table
+    with open(payload_file) as fh:
+        response = _FakeResponse(fh.read())
+    gc.collect()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with mock.patch('firecloud.api.get_entities', lambda *args, **kwargs: response):
+        start = time.perf_counter()
+        table = fetch('ns', 'ws', 'flowcell')
+        elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'implementation': implementation, 'seconds': elapsed,
+            'peak_rss_increase_mib': (peak - rss_before) / 1024,  # ru_maxrss is in KiB on Linux
+            'shape': list(table.shape),
+            'checksum': int(table.astype(str).apply(lambda col: col.str.len().sum()).sum())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--columns', type=int, default=20)
+    parser.add_argument('--implementation', choices=IMPLEMENTATIONS, help=argparse.SUPPRESS)
+    parser.add_argument('--payload', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.implementation:
+        print(json.dumps(run_one(args.implementation, args.payload)))
+        return
+
+    results = list()
+    with tempfile.NamedTemporaryFile('w', suffix='.json') as payload:
+        json.dump(synthetic_entities(args.rows, args.columns), payload)
+        payload.flush()
+        for implementation in IMPLEMENTATIONS:
+            out = subprocess.run([sys.executable, __file__, '--implementation', implementation,
+                                  '--payload', payload.name],
+                                 check=True, capture_output=True, text=True).stdout
+            results.append(json.loads(out.strip().splitlines()[-1]))
+
+    print(f"fetch_existing_root_table on {args.rows} entities x {args.columns} attributes:")
+    for r in results:
+        print(f"  {r['implementation']:>8}: {r['seconds']:.2f}s, peak RSS +{r['peak_rss_increase_mib']:.0f} MiB")
+    if results[0]['shape'] != results[1]['shape'] or results[0]['checksum'] != results[1]['checksum']:
+        sys.exit("Outputs of the two implementations differ.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Guards against import-time regressions: imports each module of the package in a fresh interpreter,
+under `python -X importtime`, and fails if it pulls in heavy dependencies it shouldn't need at import time,
+or if importing it configures logging.
+
+Cumulative import times are reported; pass --max-ms to also fail on modules slower to import than that.
+
+Usage, from the root of the repository:
+    python benchmarks/check_import_time.py [--max-ms 500]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# {module: dependencies that importing it must not load}
+FORBIDDEN_AT_IMPORT = {
+    'src': ['pandas', 'firecloud', 'google.cloud.storage', 'sendgrid', 'dateutil', 'termcolor'],
+    'src.utils': ['pandas', 'firecloud', 'google.cloud.storage', 'sendgrid', 'dateutil'],
+    'src.cromwell.utils': ['pandas', 'firecloud', 'google.cloud.storage', 'sendgrid', 'dateutil'],
+    'src.gcs_utils': ['pandas', 'firecloud', 'sendgrid'],
+    'src.terra.expt_design.definitions': ['firecloud', 'google.cloud.storage', 'sendgrid'],
+    'src.terra.table_utils': ['google.cloud.storage', 'google_crc32c', 'sendgrid'],
+    'src.terra.submission.submission_utils': ['google.cloud.storage', 'google_crc32c', 'sendgrid'],
+}
+
+_PROBE = """
+import json, logging, sys
+import {module}
+print(json.dumps({{'loaded': [m for m in {forbidden!r} if m in sys.modules],
+                   'root_handlers': len(logging.getLogger().handlers)}}))
+"""
+
+
+def check_one(module: str, forbidden: list) -> dict:
+    """
+    :return: {'loaded': forbidden modules that got loaded, 'root_handlers': number of handlers on the root logger,
+              'cumulative_ms': cumulative import time of the module}
+    """
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                                _PROBE.format(module=module, forbidden=forbidden)],
+                               cwd=REPO_ROOT, check=True, capture_output=True, text=True)
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+
+    # lines look like "import time:       self [us] |   cumulative | imported package"
+    cumulative_us = 0
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if name.strip() == module.split('.')[0] or name.strip() == module:
+            try:
+                cumulative_us = max(cumulative_us, int(cumulative))
+            except ValueError:  # the header line
+                continue
+    result['cumulative_ms'] = cumulative_us / 1000
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help='fail if importing any of the modules takes longer than this')
+    args = parser.parse_args()
+
+    problems = list()
+    for module, forbidden in FORBIDDEN_AT_IMPORT.items():
+        result = check_one(module, forbidden)
+        print(f"{module:<40} {result['cumulative_ms']:>8.1f} ms")
+        if result['loaded']:
+            problems.append(f"importing {module} loads {', '.join(result['loaded'])}")
+        if result['root_handlers']:
+            problems.append(f"importing {module} configures the root logger")
+        if args.max_ms is not None and args.max_ms < result['cumulative_ms']:
+            problems.append(f"importing {module} takes {result['cumulative_ms']:.0f} ms, over {args.max_ms:.0f} ms")
+
+    if problems:
+        sys.exit('Import-time regressions:\n  ' + '\n  '.join(problems))
+    print("No import-time regressions.")
+
+
+if __name__ == '__main__':
+    main()
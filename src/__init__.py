@@ -1,5 +1,8 @@
+import atexit
+import importlib
 import logging
 import logging.handlers
+import queue
 import sys
 
 # logging.basicConfig(stream=sys.stdout, level=logging.INFO)
@@ -8,14 +11,23 @@ import sys
 def get_configured_logger(log_level: int = logging.DEBUG,
                           flush_level: int = logging.ERROR,
                           buffer_capacity: int = 0,
-                          formatter: logging.Formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')):
+                          formatter: logging.Formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'),
+                          use_queue: bool = False):
+    """
+    Configure the root logger to write to stderr, through a buffer holding up to buffer_capacity records,
+    which is flushed when full, or when a record of flush_level or above comes in.
+
+    :param use_queue: if True, logging calls only put records on a queue, and a background thread formats and
+                      writes them (through the buffer), so that callers, e.g. loops logging per entity,
+                      never wait on formatting or I/O; whatever is queued is written out when the interpreter exits
+    """
 
     handler = __config_stream_or_file_handler(log_level, formatter)
     memory_handler = __config_memory_handler(buffer_capacity, flush_level, handler)
 
     custom_logger = logging.getLogger()
     custom_logger.setLevel(log_level)
-    custom_logger.addHandler(memory_handler)
+    custom_logger.addHandler(__config_queue_handler(memory_handler) if use_queue else memory_handler)
     return custom_logger
 
 
@@ -37,5 +49,49 @@ def __config_memory_handler(capacity: int, flush_level: int, handler: logging.ha
     )
 
 
+class _DeferredFormattingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Unlike its parent, leaves formatting records to the listener thread:
+    records never leave the process, so they needn't be made picklable first.
+
+    Note that, as a consequence, mutable arguments of a logging call are formatted as they are when written.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def __config_queue_handler(target: logging.Handler) -> logging.handlers.QueueHandler:
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, target, respect_handler_level=True)
+    listener.start()
+    atexit.register(__stop_queue_listener, listener, target)
+    return _DeferredFormattingQueueHandler(log_queue)
+
+
+def __stop_queue_listener(listener: logging.handlers.QueueListener, target: logging.Handler) -> None:
+    listener.stop()  # writes out whatever is still queued
+    target.flush()
+
+
 ########################################################################################################################
-logger = get_configured_logger(log_level=logging.INFO)
+# Importing the package, or any of its modules, has no side effects (and doesn't import the heavy dependencies):
+# call get_configured_logger() explicitly to have logs written out.
+# Submodules are imported when first accessed as attributes, e.g. lrmaCU.gcs_utils
+_SUBMODULES = ('cromwell', 'gcs_utils', 'terra', 'utils')
+_logger = None
+
+
+def __getattr__(name: str):
+    if name in _SUBMODULES:
+        return importlib.import_module(f'.{name}', __name__)
+    if 'logger' == name:  # for code relying on the logger that used to be configured at import
+        global _logger
+        if _logger is None:
+            _logger = get_configured_logger(log_level=logging.INFO)
+        return _logger
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_SUBMODULES) + ['logger'])
@@ -4,7 +4,6 @@ import urllib.request
 from enum import Enum
 from itertools import groupby
 
-from dateutil import parser
 from termcolor import colored
 
 from ..utils import *
@@ -140,8 +139,8 @@ class TaskMinimalDiagnosisMetadata:
             raise ValueError(
                 f"{self.name}'s metadata has neither returnCode nor executionStatus:\n {task_metadata}")
 
-        start = parser.isoparse(task_metadata['start'])
-        end = parser.isoparse(task_metadata['end'])
+        start = parse_iso_timestamp(task_metadata['start'])
+        end = parse_iso_timestamp(task_metadata['end'])
 
         #####
         self.attempt = int(task_metadata['attempt'])
@@ -179,8 +178,8 @@ class WorkflowMinimumDiagnosisMetadata:
 
         self.exe_status = metadata['status']
 
-        start = parser.isoparse(metadata['start'])
-        end = parser.isoparse(metadata['end'])
+        start = parse_iso_timestamp(metadata['start'])
+        end = parse_iso_timestamp(metadata['end'])
         self.timing = end - start
 
         # parse the json tree
@@ -1,13 +1,86 @@
+import base64
+import datetime
+import fnmatch
+import gzip
+import hashlib
+import io
 import logging
+import os
 import re
+import tempfile
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from enum import Enum
+from typing import TYPE_CHECKING, Dict, Iterator, List, NamedTuple, Tuple
 
+import google_crc32c
+import requests
+from google.api_core.exceptions import NotModified
 from google.cloud import storage
 
+from .utils import absolute_file_paths
+
+if TYPE_CHECKING:  # pandas is only imported by the functions needing it, as it's slow to import
+    import pandas as pd
+
 logger = logging.getLogger(__name__)
 
+RESUMABLE_UPLOAD_THRESHOLD = 32 * 1024 * 1024  # files at least this large are uploaded in resumable chunks
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # must be a multiple of 256KiB, per GCS requirement
+CRC32C_READ_SIZE = 1024 * 1024
+DOWNLOAD_SHARD_SIZE = 64 * 1024 * 1024  # byte-range size each concurrent download worker fetches
+STREAM_CHUNK_SIZE = 4 * 1024 * 1024  # size of each request when streaming an object
+GZIP_MAGIC = b'\x1f\x8b'
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'lrmaCU', 'gcs')
+DEFAULT_CACHE_MAX_BYTES = 10 * 1024 * 1024 * 1024
+HTTP_CONNECTION_POOL_SIZE = 64  # at least as many as the threads we'd run concurrently against GCS
+
 
 ########################################################################################################################
-def upload_blob(bucket_name, source_file_name, destination_blob_name):
+# A process-wide client, and cached bucket handles, so that tight loops over many paths don't pay
+# for authentication, connection setup and object construction over and over again.
+_storage_client = None
+_bucket_handles = weakref.WeakKeyDictionary()  # {client: {bucket name: bucket handle}}
+_registry_lock = threading.Lock()
+
+
+def get_storage_client() -> storage.client.Client:
+    """
+    The process-wide storage client, lazily created (in a thread-safe manner) on first use,
+    with its HTTP connection pool sized for concurrent use.
+    """
+    global _storage_client
+    if _storage_client is None:
+        with _registry_lock:
+            if _storage_client is None:
+                client = storage.Client()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_CONNECTION_POOL_SIZE,
+                                                        pool_maxsize=HTTP_CONNECTION_POOL_SIZE)
+                client._http.mount('https://', adapter)
+                _storage_client = client
+    return _storage_client
+
+
+def get_bucket(bucket_name: str, client: storage.client.Client = None) -> storage.Bucket:
+    """
+    Cached bucket handle (no request is made) for the given client, or the process-wide client if not given.
+    """
+    client = _resolve_client(client)
+    with _registry_lock:
+        handles = _bucket_handles.setdefault(client, dict())
+        if bucket_name not in handles:
+            handles[bucket_name] = client.bucket(bucket_name)
+        return handles[bucket_name]
+
+
+def _resolve_client(client: storage.client.Client or None) -> storage.client.Client:
+    return get_storage_client() if client is None else client
+
+
+########################################################################################################################
+def upload_blob(bucket_name, source_file_name, destination_blob_name, client: storage.client.Client = None):
     """
     Uploads a file to the bucket.
 
@@ -16,11 +89,11 @@ def upload_blob(bucket_name, source_file_name, destination_blob_name):
     :param bucket_name: your-bucket-name
     :param source_file_name: "local/path/to/file"
     :param destination_blob_name: "storage-object-name"
+    :param client: the process-wide client is used if not provided
     :return:
     """
 
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
+    bucket = get_bucket(bucket_name, client)
     blob = bucket.blob(destination_blob_name)
 
     blob.upload_from_filename(source_file_name)
@@ -32,6 +105,115 @@ def upload_blob(bucket_name, source_file_name, destination_blob_name):
     )
 
 
+def upload_many(bucket_name: str, sources_and_destinations: List[Tuple[str, str]],
+                client: storage.client.Client = None,
+                max_workers: int = 8,
+                skip_identical: bool = True) -> List[str]:
+    """
+    Uploads many local files to the same bucket, concurrently, re-using one client.
+
+    Files at least RESUMABLE_UPLOAD_THRESHOLD large are uploaded with chunked resumable uploads.
+    :param bucket_name: your-bucket-name
+    :param sources_and_destinations: list of ("local/path/to/file", "storage-object-name")
+    :param client: the process-wide client is used if not provided
+    :param max_workers: number of concurrent uploads
+    :param skip_identical: skip files whose size and CRC32C already match the destination blob
+    :return: the destination names actually uploaded (i.e. excluding the skipped ones)
+    """
+    bucket = get_bucket(bucket_name, client)
+
+    uploaded = list()
+    failures = dict()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(_upload_one_file, bucket, src, dst, skip_identical): (src, dst)
+                   for src, dst in sources_and_destinations}
+        for future in as_completed(futures):
+            src, dst = futures[future]
+            try:
+                if future.result():
+                    uploaded.append(dst)
+            except Exception as e:
+                logger.error(f"Failed to upload {src} to gs://{bucket_name}/{dst}: {e}")
+                failures[src] = e
+    if failures:
+        raise RuntimeError(f"Failed to upload {len(failures)} out of {len(sources_and_destinations)} files"
+                           f" to bucket {bucket_name}:\n  " + '\n  '.join(failures.keys()))
+
+    logger.info(f"Uploaded {len(uploaded)} files to bucket {bucket_name},"
+                f" skipped {len(sources_and_destinations) - len(uploaded)} identical ones.")
+    return uploaded
+
+
+def upload_directory(local_directory: str, bucket_name: str, destination_prefix: str,
+                     client: storage.client.Client = None,
+                     max_workers: int = 8,
+                     skip_identical: bool = True) -> List[str]:
+    """
+    Uploads all files (recursively) under a local directory to the bucket, keeping the relative layout.
+
+    See upload_many(...) for the meaning of the other parameters.
+    :param local_directory: "local/path/to/dir"
+    :param bucket_name: your-bucket-name
+    :param destination_prefix: "storage/prefix", under which the directory content is placed
+    :return: the destination names actually uploaded
+    """
+    root = os.path.abspath(local_directory)
+    prefix = destination_prefix.strip('/')
+    sources_and_destinations = list()
+    for f in absolute_file_paths(root):
+        relative = os.path.relpath(f, root).replace(os.sep, '/')
+        sources_and_destinations.append((f, f'{prefix}/{relative}' if prefix else relative))
+    return upload_many(bucket_name, sources_and_destinations, client=client,
+                       max_workers=max_workers, skip_identical=skip_identical)
+
+
+def _upload_one_file(bucket: storage.Bucket, source_file_name: str, destination_blob_name: str,
+                     skip_identical: bool) -> bool:
+    """
+    :return: False if the upload is skipped because the destination is identical to the local file, True otherwise
+    """
+    size = os.path.getsize(source_file_name)
+    if skip_identical:
+        existing = bucket.get_blob(destination_blob_name)
+        if existing is not None and existing.size == size \
+                and existing.crc32c == local_crc32c(source_file_name):
+            logger.debug("Skipping %s, identical to gs://%s/%s", source_file_name, bucket.name, destination_blob_name)
+            return False
+
+    blob = bucket.blob(destination_blob_name)
+    if size >= RESUMABLE_UPLOAD_THRESHOLD:
+        blob.chunk_size = UPLOAD_CHUNK_SIZE
+    blob.upload_from_filename(source_file_name, checksum='crc32c')
+    return True
+
+
+def local_crc32c(file_name: str) -> str:
+    """
+    Computes the CRC32C of a local file, in the same (base64 encoded, big-endian) format GCS reports it.
+    """
+    checksum = google_crc32c.Checksum()
+    with open(file_name, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(CRC32C_READ_SIZE), b''):
+            checksum.update(chunk)
+    return base64.b64encode(checksum.digest()).decode('utf-8')
+
+
+class GcsPathKind(Enum):
+    ABSENT = 0
+    FILE = 1
+    EMULATE_DIR = 2
+
+
+class GcsPathStat(NamedTuple):
+    kind: GcsPathKind
+    size: int = 0  # 0 unless kind is FILE
+    generation: int = None  # None unless kind is FILE
+
+    @property
+    def exists(self) -> bool:
+        return GcsPathKind.ABSENT != self.kind
+
+
 class GcsPath:
     """
     Modeling after GCS storage object.
@@ -40,7 +222,9 @@ class GcsPath:
         * checking if the paths exists, and if exists,
         * represents a file or
         * emulates a 'directory'.
-        * if a file, getting it's size and/or downloading the file as blob
+        * if a file, getting it's size and/or downloading the file as blob, or
+          downloading it to a local file with concurrent byte-range requests, or
+          streaming it line by line
     """
 
     def __init__(self, gs_path: str):
@@ -53,24 +237,607 @@ class GcsPath:
         self.prefix = '/'.join(arr[1:-1])
         self.file = arr[-1]
 
-    def get_blob(self, client: storage.client.Client) -> storage.Blob:
-        return storage.Blob(bucket=client.bucket(self.bucket), name=f'{self.prefix}/{self.file}')
+    def __str__(self):
+        return f'gs://{self.bucket}/{self.name}'
+
+    @property
+    def name(self) -> str:
+        """name of the object this path represents, i.e. sans the gs://bucket/ part"""
+        return f'{self.prefix}/{self.file}' if self.prefix else self.file
+
+    def get_blob(self, client: storage.client.Client = None) -> storage.Blob:
+        return storage.Blob(bucket=get_bucket(self.bucket, client), name=self.name)
 
-    def exists(self, client: storage.client.Client) -> bool:
-        return self.is_file(client=client) or self.is_emulate_dir(client=client)
+    def exists(self, client: storage.client.Client = None) -> bool:
+        return self.is_file(client=client) or self.__has_objects_under(client=client)
 
-    def is_file(self, client: storage.client.Client) -> bool:
-        return storage.Blob(bucket=client.bucket(self.bucket), name=f'{self.prefix}/{self.file}').exists(client)
+    def is_file(self, client: storage.client.Client = None) -> bool:
+        return self.get_blob(client).exists(_resolve_client(client))
 
-    def is_emulate_dir(self, client: storage.client.Client) -> bool:
+    def is_emulate_dir(self, client: storage.client.Client = None) -> bool:
         if self.is_file(client=client):
             return False
-        return any(True for _ in client.list_blobs(client.bucket(self.bucket), prefix=f'{self.prefix}/{self.file}'))
+        return self.__has_objects_under(client=client)
+
+    def __has_objects_under(self, client: storage.client.Client = None) -> bool:
+        return any(True for _ in _resolve_client(client).list_blobs(get_bucket(self.bucket, client),
+                                                                    prefix=self.name,
+                                                                    max_results=1))
+
+    def size(self, client: storage.client.Client = None) -> int:
+        blob = get_bucket(self.bucket, client).get_blob(self.name, client=_resolve_client(client))
+        return 0 if blob is None else blob.size
+
+    def stat(self, client: storage.client.Client = None) -> 'GcsPathStat':
+        """
+        Existence, kind, size and generation of this path, see stat_many(...) for checking many paths at once.
+        """
+        return stat_many([self], client)[0]
+
+    def download_to(self, local_path: str, client: storage.client.Client = None,
+                    parallelism: int = 8,
+                    shard_size: int = DOWNLOAD_SHARD_SIZE,
+                    verify_crc32c: bool = True) -> None:
+        """
+        Download the file this path represents to a local file,
+        by fetching byte ranges of the object concurrently and writing them in place into a pre-allocated file.
+
+        The generation of the object is pinned when the download starts, so that all ranges come from the same version.
+        The local file only appears, atomically, once all ranges are written and (optionally) the CRC32C checks out.
+        :param local_path: "local/path/to/file"
+        :param client:
+        :param parallelism: number of byte ranges fetched concurrently
+        :param shard_size: size of each byte range
+        :param verify_crc32c: check the CRC32C of the local file against that of the object
+        """
+        client = _resolve_client(client)
+        blob = self.get_blob(client)
+        blob.reload(client=client)
+        pinned = storage.Blob(bucket=blob.bucket, name=blob.name, generation=blob.generation)
+        size = blob.size
+
+        partial = f'{local_path}.part'
+        with open(partial, 'wb') as fh:
+            fh.truncate(size)
+
+        def _fetch_range(start: int, end: int) -> None:
+            with open(partial, 'r+b') as out:
+                out.seek(start)
+                pinned.download_to_file(out, client=client, start=start, end=end, checksum=None)
+
+        ranges = [(start, min(start + shard_size, size) - 1) for start in range(0, size, shard_size)]
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, parallelism)) as pool:
+                for future in [pool.submit(_fetch_range, start, end) for start, end in ranges]:
+                    future.result()
+            if verify_crc32c and blob.crc32c is not None:
+                local = local_crc32c(partial)
+                if local != blob.crc32c:
+                    raise ValueError(f"CRC32C mismatch for {self} downloaded to {local_path}:"
+                                     f" expected {blob.crc32c}, got {local}")
+        except Exception:
+            os.remove(partial)
+            raise
+        os.replace(partial, local_path)
+        logger.debug("Downloaded %s (%d bytes in %d ranges) to %s", self, size, len(ranges), local_path)
+
+    def read_bytes(self, client: storage.client.Client = None, cache: 'GcsObjectCache' = None) -> bytes:
+        """
+        Content of the file this path represents.
+
+        :param client:
+        :param cache: if provided, the content is served from (and populated into) this local cache
+        """
+        client = _resolve_client(client)
+        if cache is None:
+            return self.get_blob(client).download_as_bytes(client=client)
+        with cache.open(self, client) as fh:
+            return fh.read()
+
+    def iter_lines(self, client: storage.client.Client = None,
+                   encoding: str = 'utf-8',
+                   local_copy: str = None,
+                   cache: 'GcsObjectCache' = None) -> Iterator[str]:
+        """
+        Stream the text file this path represents, line by line, without materializing the whole file.
+
+        The content is fetched in chunks and decoded incrementally; gzip content is decompressed on the fly.
+        :param client:
+        :param encoding: text encoding of the (decompressed) content
+        :param local_copy: if provided, the object is kept in sync with this local file,
+                           and is only downloaded again when its generation changed since the last download
+        :param cache: if provided (and local_copy isn't), the content is served from (and populated into) this cache
+        :return: lines, without the line terminators
+        """
+        client = _resolve_client(client)
+        if local_copy is not None:
+            self.__sync_local_copy(client, local_copy)
+            raw = open(local_copy, 'rb')
+        elif cache is not None:
+            raw = cache.open(self, client)
+        else:
+            raw = self.get_blob(client).open('rb', chunk_size=STREAM_CHUNK_SIZE)
+
+        with io.BufferedReader(raw, buffer_size=STREAM_CHUNK_SIZE) as buffered:
+            stream = gzip.GzipFile(fileobj=buffered) if buffered.peek(2)[:2] == GZIP_MAGIC else buffered
+            for line in io.TextIOWrapper(stream, encoding=encoding):
+                yield line.rstrip('\n')
+
+    def read_tsv(self, client: storage.client.Client = None,
+                 sep: str = '\t',
+                 encoding: str = 'utf-8',
+                 local_copy: str = None,
+                 cache: 'GcsObjectCache' = None) -> Iterator[Tuple[str, ...]]:
+        """
+        Stream the (delimited) text file this path represents, record by record; empty lines are skipped.
+
+        See iter_lines(...) for the parameters.
+        :return: fields of each record
+        """
+        for line in self.iter_lines(client, encoding=encoding, local_copy=local_copy, cache=cache):
+            if line:
+                yield tuple(line.split(sep))
+
+    def __sync_local_copy(self, client: storage.client.Client, local_copy: str) -> None:
+        """
+        Conditionally download the object to local_copy: skipped entirely if the local copy is of the same generation.
+
+        The generation of the local copy is recorded in a side-car file f"{local_copy}.generation".
+        """
+        generation_record = f'{local_copy}.generation'
+        recorded_generation = None
+        if os.path.isfile(local_copy) and os.path.isfile(generation_record):
+            with open(generation_record) as fh:
+                recorded_generation = int(fh.read().strip())
+
+        blob = self.get_blob(client)
+        partial = f'{local_copy}.part'
+        try:
+            blob.download_to_filename(partial, client=client, if_generation_not_match=recorded_generation)
+        except NotModified:
+            if os.path.isfile(partial):
+                os.remove(partial)
+            logger.debug("Local copy %s of %s is current, download skipped.", local_copy, self)
+            return
+        if blob.generation is None:
+            blob.reload(client=client)
+        os.replace(partial, local_copy)
+        with open(generation_record, 'w') as fh:
+            fh.write(str(blob.generation))
+
+
+class GcsObjectCache:
+    """
+    A local, size-bounded cache of GCS objects, e.g. for reference files repeatedly read by scheduled jobs.
+
+    Entries are keyed by (bucket, object name, generation), so a cached entry never goes stale:
+    a new version of an object is a new generation, hence a new entry.
+    Reads only cost a metadata request to learn the current generation of the object.
+
+    Entries are written to a temporary file and atomically renamed into place, and eviction tolerates entries
+    disappearing underneath it, so concurrent processes can share one cache directory;
+    to read an entry that a concurrent process may evict at any time, use open(...), not path_for(...).
+    When the total size exceeds max_bytes, the least recently used entries are evicted,
+    along with partial downloads left behind by crashed processes.
+    """
+
+    PARTIAL_SUFFIX = '.part'
+    STALE_PARTIAL_SECONDS = 3600  # partial downloads not written to for this long are considered abandoned
+    OPEN_ATTEMPTS = 3  # number of times open(...) re-fetches an entry evicted before it could be opened
+
+    def __init__(self, root_dir: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_CACHE_MAX_BYTES):
+        self.root_dir = root_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.root_dir, exist_ok=True)
 
-    def size(self, client: storage.client.Client) -> int:
-        blob = storage.Blob(bucket=client.bucket(self.bucket), name=f'{self.prefix}/{self.file}')
-        if blob.exists(client=client):
-            blob.reload()
-            return blob.size
+    def open(self, gcs_path: GcsPath, client: storage.client.Client = None) -> io.BufferedReader:
+        """
+        Binary file object on the content of the current generation of the requested object,
+        downloading it into the cache if not already there.
+
+        Once opened, the content stays readable even if a concurrent process evicts the entry.
+        """
+        client = _resolve_client(client)
+        for attempt in range(1, GcsObjectCache.OPEN_ATTEMPTS + 1):
+            local = self.path_for(gcs_path, client)
+            try:
+                return open(local, 'rb')
+            except FileNotFoundError:
+                if GcsObjectCache.OPEN_ATTEMPTS == attempt:
+                    raise
+                logger.debug("Cache entry %s of %s evicted before it could be opened, re-fetching.", local, gcs_path)
+
+    def path_for(self, gcs_path: GcsPath, client: storage.client.Client = None) -> str:
+        """
+        Local path holding the content of the current generation of the requested object,
+        downloading it into the cache if not already there.
+
+        Note that when the cache directory is shared, a concurrent process may evict the entry at any time;
+        prefer open(...) for reading.
+        """
+        client = _resolve_client(client)
+        blob = gcs_path.get_blob(client)
+        blob.reload(client=client)
+        local = self.__entry_path(blob.bucket.name, blob.name, blob.generation)
+        if os.path.isfile(local):
+            try:
+                os.utime(local)  # marks the entry as recently used
+                logger.debug("Cache hit for %s (generation %s).", gcs_path, blob.generation)
+                return local
+            except FileNotFoundError:  # evicted by a concurrent process just now
+                pass
+
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        fd, partial = tempfile.mkstemp(dir=os.path.dirname(local), suffix=GcsObjectCache.PARTIAL_SUFFIX)
+        os.close(fd)
+        try:
+            pinned = storage.Blob(bucket=blob.bucket, name=blob.name, generation=blob.generation)
+            pinned.download_to_filename(partial, client=client)
+            os.replace(partial, local)
+        except Exception:
+            if os.path.isfile(partial):
+                os.remove(partial)
+            raise
+        logger.debug("Cached %s (generation %s) at %s.", gcs_path, blob.generation, local)
+
+        self.evict(keep=local)
+        return local
+
+    def evict(self, keep: str = None) -> None:
+        """
+        Evict least recently used entries until the cache is within its size bound,
+        and remove partial downloads abandoned (e.g. by crashed processes) for more than STALE_PARTIAL_SECONDS.
+        :param keep: an entry never to be evicted (e.g. the one just added)
+        """
+        stale_before = time.time() - GcsObjectCache.STALE_PARTIAL_SECONDS
+        entries = list()
+        for dir_path, _, file_names in os.walk(self.root_dir):
+            for f in file_names:
+                p = os.path.join(dir_path, f)
+                try:
+                    st = os.stat(p)
+                    if f.endswith(GcsObjectCache.PARTIAL_SUFFIX):
+                        if st.st_mtime < stale_before:
+                            os.remove(p)
+                            logger.debug("Removed abandoned partial download %s.", p)
+                        continue
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, p))
+
+        total = sum(e[1] for e in entries)
+        for _, size, p in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if p == keep:
+                continue
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def __entry_path(self, bucket: str, name: str, generation: int) -> str:
+        key = hashlib.sha256(f'{bucket}/{name}#{generation}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.root_dir, key[:2], key)
+
+
+def download_many(paths: List[GcsPath], local_directory: str, client: storage.client.Client = None,
+                  max_workers: int = 4,
+                  parallelism_per_file: int = 4) -> List[str]:
+    """
+    Download many files to a local directory, concurrently, using GcsPath.download_to for each file.
+
+    :param paths: files to download; their file names must be unique
+    :param local_directory: where to put the files, created if not existing
+    :param client:
+    :param max_workers: number of files downloaded concurrently
+    :param parallelism_per_file: number of byte ranges fetched concurrently for each file
+    :return: local paths of the downloaded files, in the same order as the input
+    """
+    file_names = [p.file for p in paths]
+    if len(set(file_names)) != len(file_names):
+        raise ValueError("Requested files to download don't have unique file names.")
+
+    client = _resolve_client(client)
+    os.makedirs(local_directory, exist_ok=True)
+    local_paths = [os.path.join(local_directory, f) for f in file_names]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(p.download_to, local, client, parallelism_per_file)
+                   for p, local in zip(paths, local_paths)]
+        for p, future in zip(paths, futures):
+            try:
+                future.result()
+            except Exception:
+                logger.error(f"Failed to download {p}")
+                raise
+    return local_paths
+
+
+def stat_many(paths: List[GcsPath], client: storage.client.Client = None, max_workers: int = 8) -> List[GcsPathStat]:
+    """
+    Bulk version of GcsPath.exists/is_file/is_emulate_dir/size.
+
+    Instead of several requests per path, paths are grouped by (bucket, prefix),
+    and each group is resolved with a single delimiter-based listing of that prefix;
+    the groups are listed concurrently.
+    Note that a path is considered an emulated directory if it is a proper "directory" (i.e. objects exist under
+    f"{path}/"), unlike GcsPath.is_emulate_dir, which is a plain prefix match.
+    :param paths: paths to check
+    :param client:
+    :param max_workers: number of concurrent listings
+    :return: stat of each path, in the same order as the input
+    """
+    client = _resolve_client(client)
+    groups = dict()
+    for p in paths:
+        groups.setdefault((p.bucket, p.prefix), set()).add(p.file)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {k: pool.submit(_stat_one_prefix, client, k[0], k[1], v) for k, v in groups.items()}
+        resolved = {k: f.result() for k, f in futures.items()}
+
+    return [resolved[(p.bucket, p.prefix)][p.file] for p in paths]
+
+
+def _stat_one_prefix(client: storage.client.Client, bucket: str, prefix: str, file_names: set) \
+        -> Dict[str, GcsPathStat]:
+    listing = client.list_blobs(get_bucket(bucket, client), prefix=f'{prefix}/' if prefix else '', delimiter='/',
+                                fields='items(name,size,generation),prefixes,nextPageToken')
+    files = {blob.name: blob for blob in listing}
+    sub_dirs = listing.prefixes  # only populated after the listing is exhausted
+
+    res = dict()
+    for f in file_names:
+        name = f'{prefix}/{f}' if prefix else f
+        if '' == f:  # path with a trailing '/'
+            kind = GcsPathKind.EMULATE_DIR if (files or sub_dirs) else GcsPathKind.ABSENT
+            res[f] = GcsPathStat(kind)
+        elif name in files:
+            blob = files[name]
+            res[f] = GcsPathStat(GcsPathKind.FILE, blob.size, blob.generation)
+        elif f'{name}/' in sub_dirs:
+            res[f] = GcsPathStat(GcsPathKind.EMULATE_DIR)
         else:
-            return 0
+            res[f] = GcsPathStat(GcsPathKind.ABSENT)
+    return res
+
+
+########################################################################################################################
+class GcsPrefixIndex:
+    """
+    An in-memory snapshot of all objects under a prefix of a bucket,
+    so that repeated exists/is_dir/size/glob queries against that prefix are answered locally.
+
+    The prefix is listed once: a delimiter-based listing discovers the immediate "sub-directories",
+    whose contents are then listed concurrently.
+    Object names are kept in a trie of name segments, each object carrying (size, updated time, generation).
+
+    The GCS listing API doesn't support filtering by update time,
+    so refresh() re-lists (with a minimal field projection) and applies only the differences to the snapshot,
+    reporting what was added, updated or removed since the last snapshot.
+    """
+
+    __OBJECT = None  # key in a trie node holding the (size, updated, generation) of the object ending at that node
+
+    def __init__(self, gs_prefix: str, client: storage.client.Client = None, max_workers: int = 8):
+        if not gs_prefix.startswith("gs://"):
+            raise ValueError(f"Provided gs path isn't valid: {gs_prefix}")
+
+        arr = re.sub("^gs://", '', gs_prefix).rstrip('/').split('/', 1)
+        self.bucket = arr[0]
+        self.prefix = arr[1] if 1 < len(arr) else ''
+        self.client = _resolve_client(client)
+        self.max_workers = max_workers
+
+        self._trie = dict()
+        self._objects = dict()  # object name -> (size, updated, generation), mirroring the trie for cheap diffing
+        self.snapshot_time = None
+        self.refresh()
+
+    def refresh(self) -> Dict[str, List[str]]:
+        """
+        Re-list the prefix and update the snapshot.
+        :return: {'added': [...], 'updated': [...], 'removed': [...]} object names since the previous snapshot
+        """
+        snapshot_time = datetime.datetime.now(tz=datetime.timezone.utc)
+        latest = self.__list_all()
+
+        added = [n for n in latest if n not in self._objects]
+        updated = [n for n in latest if n in self._objects and latest[n][2] != self._objects[n][2]]
+        removed = [n for n in self._objects if n not in latest]
+
+        for n in removed:
+            self.__remove(n)
+        for n in added + updated:
+            self.__insert(n, latest[n])
+        self._objects = latest
+        self.snapshot_time = snapshot_time
+
+        logger.debug("Indexed %d objects under gs://%s/%s: %d added, %d updated, %d removed.",
+                     len(latest), self.bucket, self.prefix, len(added), len(updated), len(removed))
+        return {'added': added, 'updated': updated, 'removed': removed}
+
+    def exists(self, gs_path: str) -> bool:
+        return self.is_file(gs_path) or self.is_dir(gs_path)
+
+    def is_file(self, gs_path: str) -> bool:
+        return self.__object_name(gs_path) in self._objects
+
+    def is_dir(self, gs_path: str) -> bool:
+        node = self.__find(self.__object_name(gs_path).rstrip('/'))
+        return node is not None and any(k is not GcsPrefixIndex.__OBJECT for k in node)
+
+    def size(self, gs_path: str) -> int:
+        info = self._objects.get(self.__object_name(gs_path))
+        return 0 if info is None else info[0]
+
+    def updated(self, gs_path: str) -> datetime.datetime or None:
+        info = self._objects.get(self.__object_name(gs_path))
+        return None if info is None else info[1]
+
+    def glob(self, pattern: str) -> List[str]:
+        """
+        Directory-style globbing: pattern segments are matched one at a time against the indexed names' segments,
+        so '*', '?' and '[...]' never match across '/', while a '**' segment matches any number of segments.
+        :param pattern: fnmatch-style pattern on full gs:// paths,
+                        e.g. 'gs://bucket/vcfs/*.vcf.gz' (directly under vcfs/),
+                        or 'gs://bucket/vcfs/**/*.vcf.gz' (anywhere under vcfs/)
+        :return: matching gs:// paths of objects
+        """
+        segments = self.__object_name(pattern).split('/')
+        # dict.fromkeys: consecutive '**' segments can reach the same object more than once
+        return [f'gs://{self.bucket}/{n}' for n in dict.fromkeys(self.__match(self._trie, segments, list()))]
+
+    def names(self) -> Iterator[str]:
+        """gs:// paths of all indexed objects"""
+        return (f'gs://{self.bucket}/{n}' for n in self._objects)
+
+    ####################################################################################################################
+    def __list_all(self) -> Dict[str, Tuple[int, datetime.datetime, int]]:
+        fields = 'items(name,size,updated,generation),prefixes,nextPageToken'
+        bucket = get_bucket(self.bucket, self.client)
+        prefix = f'{self.prefix}/' if self.prefix else ''
+
+        top = self.client.list_blobs(bucket, prefix=prefix, delimiter='/', fields=fields)
+        res = {b.name: (b.size, b.updated, b.generation) for b in top}
+
+        def _list_sub_dir(sub_prefix: str) -> List[storage.Blob]:
+            return list(self.client.list_blobs(bucket, prefix=sub_prefix, fields=fields))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for blobs in pool.map(_list_sub_dir, sorted(top.prefixes)):
+                res.update({b.name: (b.size, b.updated, b.generation) for b in blobs})
+        return res
+
+    def __object_name(self, gs_path: str) -> str:
+        gs_path = str(gs_path)
+        head = f'gs://{self.bucket}/'
+        if not gs_path.startswith(head):
+            raise ValueError(f"{gs_path} isn't under the indexed bucket {self.bucket}")
+        return gs_path[len(head):]
+
+    def __find(self, name: str) -> dict or None:
+        node = self._trie
+        for segment in name.split('/'):
+            node = node.get(segment)
+            if node is None:
+                return None
+        return node
+
+    def __insert(self, name: str, info: tuple) -> None:
+        node = self._trie
+        for segment in name.split('/'):
+            node = node.setdefault(segment, dict())
+        node[GcsPrefixIndex.__OBJECT] = info
+
+    def __remove(self, name: str) -> None:
+        path = [self._trie]
+        for segment in name.split('/'):
+            path.append(path[-1][segment])
+        del path[-1][GcsPrefixIndex.__OBJECT]
+        # prune now-empty nodes, bottom up
+        segments = name.split('/')
+        for i in range(len(segments) - 1, -1, -1):
+            if path[i + 1]:
+                break
+            del path[i][segments[i]]
+
+    @staticmethod
+    def __match(node: dict, pattern_segments: List[str], segments: List[str]) -> Iterator[str]:
+        if not pattern_segments:
+            if GcsPrefixIndex.__OBJECT in node:
+                yield '/'.join(segments)
+            return
+        head, rest = pattern_segments[0], pattern_segments[1:]
+        if '**' == head:
+            # '**' matching no segment, or this node's children followed by '**' again
+            yield from GcsPrefixIndex.__match(node, rest, segments)
+            for k, child in node.items():
+                if k is not GcsPrefixIndex.__OBJECT:
+                    yield from GcsPrefixIndex.__match(child, pattern_segments, segments + [k])
+        elif not any(c in head for c in '*?['):
+            # literal segment: a single lookup instead of a scan of the children
+            child = node.get(head)
+            if child is not None:
+                yield from GcsPrefixIndex.__match(child, rest, segments + [head])
+        else:
+            for k, child in node.items():
+                if k is not GcsPrefixIndex.__OBJECT and fnmatch.fnmatchcase(k, head):
+                    yield from GcsPrefixIndex.__match(child, rest, segments + [k])
+
+
+########################################################################################################################
+def copy_many(sources_and_destinations: List[Tuple[GcsPath, GcsPath]],
+              client: storage.client.Client = None,
+              max_workers: int = 16,
+              skip_identical: bool = True) -> 'pd.DataFrame':
+    """
+    Copies many objects, possibly across buckets, server-side, i.e. bytes never go through this machine.
+
+    Each copy is a GCS rewrite, which for huge objects (or across locations/storage classes) may take several calls;
+    the rewrite token returned by each call is used to resume in the next, until the copy completes.
+    Failures don't stop the other copies; check the returned table.
+    :param sources_and_destinations: list of (source, destination) pairs, i.e. a manifest
+    :param client: the process-wide client is used if not provided
+    :param max_workers: number of concurrent rewrites
+    :param skip_identical: skip copies whose destination already has the same size and CRC32C as the source
+    :return: one row per pair, columns ['source', 'destination', 'status', 'bytes', 'error'],
+             where status is one of 'copied', 'skipped', 'failed'
+    """
+    client = _resolve_client(client)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(_rewrite_one, src, dst, client, skip_identical) for src, dst in sources_and_destinations]
+        records = list()
+        for (src, dst), future in zip(sources_and_destinations, futures):
+            try:
+                status, num_bytes = future.result()
+                records.append((str(src), str(dst), status, num_bytes, None))
+            except Exception as e:
+                records.append((str(src), str(dst), 'failed', 0, str(e)))
+
+    import pandas as pd  # only the bulk copy reports need pandas, which is slow to import
+
+    results = pd.DataFrame.from_records(records, columns=['source', 'destination', 'status', 'bytes', 'error'])
+    failed = results[results['status'] == 'failed']
+    if 0 < len(failed):
+        logger.warning(f"Failed to copy {len(failed)} out of {len(results)} objects:\n"
+                       f"{failed[['source', 'destination']].to_string(index=False)}")
+    logger.info(f"Copied {(results['status'] == 'copied').sum()} objects ({results['bytes'].sum()} bytes),"
+                f" skipped {(results['status'] == 'skipped').sum()} identical ones.")
+    return results
+
+
+def copy_from_manifest(manifest_tsv: str,
+                       client: storage.client.Client = None,
+                       max_workers: int = 16,
+                       skip_identical: bool = True) -> 'pd.DataFrame':
+    """
+    Same as copy_many(...), with the (source, destination) pairs read from a headerless, two-column local TSV
+    of gs:// paths.
+    """
+    import pandas as pd
+
+    manifest = pd.read_csv(manifest_tsv, sep='\t', header=None, names=['source', 'destination'], dtype=str)
+    pairs = [(GcsPath(src), GcsPath(dst)) for src, dst in zip(manifest['source'], manifest['destination'])]
+    return copy_many(pairs, client=client, max_workers=max_workers, skip_identical=skip_identical)
+
+
+def _rewrite_one(source: GcsPath, destination: GcsPath, client: storage.client.Client,
+                 skip_identical: bool) -> Tuple[str, int]:
+    """
+    :return: (status, bytes copied)
+    """
+    source_blob = source.get_blob(client)
+    destination_blob = destination.get_blob(client)
+    if skip_identical:
+        source_blob.reload(client=client)
+        existing = get_bucket(destination.bucket, client).get_blob(destination_blob.name, client=client)
+        if existing is not None and existing.size == source_blob.size and existing.crc32c == source_blob.crc32c:
+            return 'skipped', 0
+
+    token, rewritten, total = destination_blob.rewrite(source_blob, client=client)
+    while token is not None:
+        logger.debug("Rewriting %s to %s: %s/%s bytes", source, destination, rewritten, total)
+        token, rewritten, total = destination_blob.rewrite(source_blob, token=token, client=client)
+    return 'copied', total
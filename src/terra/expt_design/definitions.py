@@ -1,10 +1,16 @@
+import logging
+import os
 import pprint
 import re
+import sys
+from collections.abc import Mapping
 from enum import Enum
-from typing import List, Dict, Tuple
+from typing import List, Dict, Iterable, Iterator, Tuple
 
 import pandas as pd
 
+logger = logging.getLogger(__name__)
+
 
 # THIS SERVES AS TEMPLATE ON HOW TO DESCRIBE EXPERIMENT DESIGNS FOR MANY PROJECTS
 
@@ -64,9 +70,12 @@ class Flowcell:
     See: understand_vocabulary()
     """
 
+    __slots__ = ('parti_uuid', 'extraction', 'tissue', 'uuid', 'flowcell_description', 'tech', 'sample_uuid',
+                 'attributes')
+
     extract = f"{'|'.join(ExtractionProtocol.list())}"
-    tissue = f"{'|'.join(TissueType.list())}"
-    hud_alpha_participant_description_pattern = re.compile(f"(T[0-9]+)_([0-9]+_)*({extract})_({tissue})")
+    tissues = f"{'|'.join(TissueType.list())}"
+    hud_alpha_participant_description_pattern = re.compile(f"(T[0-9]+)_([0-9]+_)*({extract})_({tissues})")
     fc_appendix_pattern = re.compile("(_)?[a-zA-Z]+$")
 
     @staticmethod
@@ -75,11 +84,31 @@ class Flowcell:
 
     def __init__(self, flowcell_uuid: str, tech: str, flowcell_description: str,
                  extra_description: dict = None):
-        self.parti_uuid, blah, self.extraction, self.tissue = \
-            Flowcell.parse_flowcell_description(flowcell_description)
+        parti_uuid, blah, extraction, tissue = Flowcell.parse_flowcell_description(flowcell_description)
+        self.__populate(flowcell_uuid, tech, flowcell_description, parti_uuid, extraction, tissue, extra_description)
+
+    @classmethod
+    def from_parsed_description(cls, flowcell_uuid: str, tech: str, flowcell_description: str,
+                                parti_uuid: str, extraction: str, tissue: str,
+                                extra_description: dict = None) -> 'Flowcell':
+        """
+        Construct a flowcell whose description has already been parsed and validated
+        (e.g. by parse_flowcell_descriptions), without parsing it again.
+        """
+        fc = cls.__new__(cls)
+        fc.__populate(flowcell_uuid, tech, flowcell_description, parti_uuid, extraction, tissue, extra_description)
+        return fc
+
+    def __populate(self, flowcell_uuid: str, tech: str, flowcell_description: str,
+                   parti_uuid: str, extraction: str, tissue: str,
+                   extra_description: dict = None) -> None:
+        # these few values are shared by many flowcells
+        self.parti_uuid = sys.intern(parti_uuid)
+        self.extraction = sys.intern(extraction)
+        self.tissue = sys.intern(tissue)
         self.uuid = flowcell_uuid
         self.flowcell_description = flowcell_description
-        self.tech = tech
+        self.tech = sys.intern(tech)
 
         # example: 6061-SL-0052_c and 6061-SL-0050b, they are top-offs, indicating
         # multiple FCs exist for the same participant's same tissue extracted with the same protocol
@@ -104,9 +133,62 @@ class Flowcell:
                              f" Specifically, its tissue type is not one of {TissueType.list()}.")
         return parsed_result
 
+    @classmethod
+    def parse_flowcell_descriptions(cls, participant_infos: pd.Series) -> pd.DataFrame:
+        """
+        Vectorized version of parse_flowcell_description, parsing and validating a whole column of descriptions at once.
+        :return: 3-col dataframe ['participant', 'extraction', 'tissue'], indexed the same as the input
+        """
+        parsed = participant_infos.astype(str).str.extract(cls.hud_alpha_participant_description_pattern)
+        parsed = parsed[[0, 2, 3]]
+        parsed.columns = ['participant', 'extraction', 'tissue']
+
+        unparsable = parsed['participant'].isna()
+        if unparsable.any():
+            raise ValueError(f"Provided participants {participant_infos[unparsable].tolist()} don't seem to conform"
+                             f" the expected format.")
+        bad_extraction = ~parsed['extraction'].isin(ExtractionProtocol.__members__)
+        if bad_extraction.any():
+            raise ValueError(f"Provided participants {participant_infos[bad_extraction].tolist()} don't seem to conform"
+                             f" the expected format. Specifically, their extraction method is not one of"
+                             f" {ExtractionProtocol.list()}.")
+        bad_tissue = ~parsed['tissue'].isin(TissueType.__members__)
+        if bad_tissue.any():
+            raise ValueError(f"Provided participants {participant_infos[bad_tissue].tolist()} don't seem to conform"
+                             f" the expected format. Specifically, their tissue type is not one of"
+                             f" {TissueType.list()}.")
+        return parsed
+
+
+class LazyFlowcells(Mapping):
+    """
+    Read-only {flowcell_uuid: Flowcell} mapping over columns of already parsed flowcell annotations,
+    where each Flowcell object is only constructed, once, when it is first looked up.
+    """
+
+    def __init__(self, uuids: Iterable[str], techs: Iterable[str], descriptions: Iterable[str],
+                 parti_uuids: Iterable[str], extractions: Iterable[str], tissues: Iterable[str]):
+        self.__fields = {row[0]: row for row in zip(uuids, techs, descriptions, parti_uuids, extractions, tissues)}
+        self.__flowcells = dict()
+
+    def __getitem__(self, flowcell_uuid: str) -> Flowcell:
+        fc = self.__flowcells.get(flowcell_uuid)
+        if fc is None:
+            fc = Flowcell.from_parsed_description(*self.__fields[flowcell_uuid])
+            self.__flowcells[flowcell_uuid] = fc
+        return fc
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.__fields)
+
+    def __len__(self) -> int:
+        return len(self.__fields)
+
 
 class Sample:
 
+    __slots__ = ('flowcells_uuid', 'parti_uuid', 'classifier_values')
+
     @staticmethod
     def self_describe() -> str:
         return (
@@ -120,41 +202,53 @@ class Sample:
 
     def __init__(self, flowcells: List[Flowcell],
                  classifier_names_and_values: List[Tuple[str, str]]):
-        for n, v in classifier_names_and_values:
-            if n not in Classifier.list():
-                raise KeyError(f"unsupported classifier name {n}. Accepted values are {Classifier.list()}.")
-
         Sample.__validate_flowcells(flowcells, classifier_names_and_values)
+        self.__populate(flowcells[0].parti_uuid, tuple(fc.uuid for fc in flowcells), classifier_names_and_values)
 
-        self.flowcells_uuid = [fc.uuid for fc in flowcells]
-
-        fc = flowcells[0]
-        self.parti_uuid = fc.parti_uuid
+    @classmethod
+    def from_grouped_flowcells(cls, parti_uuid: str, flowcells_uuid: Tuple[str, ...],
+                               classifier_names_and_values: List[Tuple[str, str]]) -> 'Sample':
+        """
+        Construct a sample from flowcells already known to be from the participant, and to share the classifier values,
+        e.g. because they are grouped together by these columns of an annotated table;
+        hence the flowcells themselves need not be looked at.
+        """
+        Sample.__validate_classifier_names(classifier_names_and_values)
+        sm = cls.__new__(cls)
+        sm.__populate(parti_uuid, flowcells_uuid, classifier_names_and_values)
+        return sm
+
+    def __populate(self, parti_uuid: str, flowcells_uuid: Tuple[str, ...],
+                   classifier_names_and_values: List[Tuple[str, str]]) -> None:
+        self.flowcells_uuid = flowcells_uuid
+        self.parti_uuid = sys.intern(parti_uuid)
+        self.classifier_values = sys.intern('_'.join([t[1] for t in classifier_names_and_values]))
+
+    @property
+    def uuid(self) -> str:
+        # composed on demand, as there are many more samples than distinct participants and classifier values
+        return f"{self.parti_uuid}_{self.classifier_values}"
 
-        postfix = '_'.join([t[1] for t in classifier_names_and_values])
-        self.uuid = f"{self.parti_uuid}_{postfix}"
+    @classmethod
+    def __validate_classifier_names(cls, classifier_names_and_values: List[Tuple[str, str]]) -> None:
+        for n, v in classifier_names_and_values:
+            if n not in Classifier.__members__:
+                raise KeyError(f"unsupported classifier name {n}. Accepted values are {Classifier.list()}.")
 
     @classmethod
     def __validate_flowcells(cls, flowcells: List[Flowcell],
                              classifier_names_and_values: List[Tuple[str, str]]) -> None:
-        tissues = set([fc.tissue for fc in flowcells])
-        extractions = set([fc.extraction for fc in flowcells])
-        techs = set([fc.tech for fc in flowcells])
-        for t in classifier_names_and_values:
-            c = t[0]
-            if c == Classifier.tech.name.lstrip("Classifier."):
-                if len(techs) != 1:
-                    raise ValueError(f"Provided flowcells to construct sample don't share the same tech.")
-            elif c == Classifier.tissue.name.lstrip("Classifier."):
-                if len(tissues) != 1:
-                    raise ValueError(f"Provided flowcells to construct sample don't share the same tissue.")
-            elif c == Classifier.extraction.name.lstrip("Classifier."):
-                if len(extractions) != 1:
-                    raise ValueError(f"Provided flowcells to construct sample don't share the same extraction.")
+        cls.__validate_classifier_names(classifier_names_and_values)
+        # classifier names are also names of the corresponding attributes of flowcells
+        for c, v in classifier_names_and_values:
+            if len({getattr(fc, c) for fc in flowcells}) != 1:
+                raise ValueError(f"Provided flowcells to construct sample don't share the same {c}.")
 
 
 class Participant:
 
+    __slots__ = ('samples_uuid', 'uuid')
+
     @staticmethod
     def self_describe() -> str:
         return "the actual individual donating the DNA"
@@ -162,7 +256,7 @@ class Participant:
     def __init__(self, samples: List[Sample]):
         Participant.__validate_samples(samples)
 
-        self.samples_uuid = [sm.uuid for sm in samples]
+        self.samples_uuid = tuple(sm.uuid for sm in samples)
         self.uuid = samples[0].parti_uuid
 
     @classmethod
@@ -186,3 +280,43 @@ class TablesReadyForUpload:
         self.mega_set_table = mega_set_table
         self.individual_set_tables = individual_set_tables
         self.participant_table = participant_table
+
+    def upload_all(self, ns: str, ws: str, max_workers: int = 4, checkpoint_dir: str = None) -> None:
+        """
+        Upload all the tables to Terra ns/ws, in the order their entities depend on each other:
+          1. the root level table,
+          2. all the set level tables (individual ones and the mega one) together, with members filled in in bulk,
+          3. the participant table, where samples are uploaded as lists of sample names.
+        Each stage uploads in chunks of rows, concurrently, and retries failed chunks on their own.
+
+        :param ns:
+        :param ws:
+        :param max_workers: number of chunks uploaded concurrently
+        :param checkpoint_dir: if provided, progress of each stage is recorded in a file under it,
+                               and re-running after a failure only uploads what's left
+        :return:
+        """
+        # imported here, as the data model shouldn't pull in the Terra and GCS clients until asked to upload
+        from ..table_utils import upload_root_table_in_chunks, upload_set_tables_in_chunks, format_attribute_for_tsv
+
+        if checkpoint_dir:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+
+        def _checkpoint(stage: str) -> str or None:
+            return os.path.join(checkpoint_dir, f'{stage}.json') if checkpoint_dir else None
+
+        logger.info(f"Stage 1/3: uploading root level table ({len(self.root_level_table)} rows) to {ns}/{ws}.")
+        upload_root_table_in_chunks(ns, ws, self.root_level_table,
+                                    max_workers=max_workers, checkpoint_file=_checkpoint('root'))
+
+        set_tables = list(self.individual_set_tables.values()) + [self.mega_set_table]
+        logger.info(f"Stage 2/3: uploading {len(set_tables)} set level tables"
+                    f" ({sum(len(t) for t in set_tables)} rows) to {ns}/{ws}.")
+        upload_set_tables_in_chunks(ns, ws, set_tables, membership_col_name=self.mega_set_table.columns[1],
+                                    max_workers=max_workers, checkpoint_file=_checkpoint('sets'))
+
+        logger.info(f"Stage 3/3: uploading participant table ({len(self.participant_table)} rows) to {ns}/{ws}.")
+        participant_table = self.participant_table.apply(lambda col: col.map(format_attribute_for_tsv))
+        upload_root_table_in_chunks(ns, ws, participant_table,
+                                    max_workers=max_workers, checkpoint_file=_checkpoint('participants'))
+        logger.info(f"All tables uploaded to {ns}/{ws}.")
@@ -1,16 +1,21 @@
 import itertools
 import re
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, Iterator, List, Mapping, Tuple
 
+import numpy as np
 import pandas as pd
 
 from src.terra.expt_design import definitions
-from src.terra.expt_design.definitions import TablesReadyForUpload, SequencingTechnology, Flowcell, Sample
+from src.terra.expt_design.definitions import TablesReadyForUpload, SequencingTechnology, Flowcell, Sample, \
+    LazyFlowcells
+from src.terra.table_utils import upload_table_chunks
 
 SELECTION_CRITERION = ['tech', 'tissue', 'extraction']
 SELECTION_CRITERIA = list(itertools.combinations(SELECTION_CRITERION, 2))
 
+INTAKE_CHUNK_SIZE = 10000  # number of rows read, annotated and uploaded at a time when streaming a local table
+
 
 def make_tables_ready_for_upload(table_to_process: str, tech: str, column_name_conforming_to_naming_schema: str) -> \
         TablesReadyForUpload:
@@ -29,27 +34,25 @@ def make_tables_ready_for_upload(table_to_process: str, tech: str, column_name_c
     if tech not in SequencingTechnology.list():
         raise ValueError(f"Provided tech value isn't in the accepted list: {SequencingTechnology.list()}")
 
-    ready_root_table, fc_uuid_2_fc_obj = \
+    ready_root_table, _ = \
         annotate_and_make_ready_root_table(table_to_process, tech, column_name_conforming_to_naming_schema)
 
     # then classify and mega-merge
-    classified_tables, flowcell_mega_set_table = make_set_tables(ready_root_table, tech, fc_uuid_2_fc_obj)
+    classified_tables, flowcell_mega_set_table = make_set_tables(ready_root_table, tech)
 
     definitions.understand_vocabulary()
-    participants = list()
-    for p in flowcell_mega_set_table['participant'].unique():
-        participants.append((p,
-                             flowcell_mega_set_table[flowcell_mega_set_table['participant'] == p].iloc[:, 0].tolist())
-                            )
-    participants_table = pd.DataFrame.from_records(participants,
-                                                   columns=['entity:participant_id', f'{tech.lower()}-samples'])
+    participants_table = flowcell_mega_set_table\
+        .groupby('participant', sort=False)[flowcell_mega_set_table.columns[0]]\
+        .agg(list)\
+        .reset_index()
+    participants_table.columns = ['entity:participant_id', f'{tech.lower()}-samples']
 
     return TablesReadyForUpload(ready_root_table, classified_tables, flowcell_mega_set_table, participants_table)
 
 
 ########################################################################################################################
 def annotate_and_make_ready_root_table(table_to_process: str, tech: str, column_name_conforming_to_naming_schema: str) \
-        -> (pd.DataFrame, Dict[str, Flowcell]):
+        -> (pd.DataFrame, Mapping[str, Flowcell]):
     """
     Annotate root table and make it ready for uploading to Terra.
     :return: a tuple 2 of (formatted table, a dictionary of {flowcell_uuid: Flowcell_object})
@@ -58,32 +61,86 @@ def annotate_and_make_ready_root_table(table_to_process: str, tech: str, column_
     if not Path(table_to_process).is_file():
         raise ValueError(f"Terra table TSV {table_to_process} doesn't seem to exist.")
 
-    # load root level table to be annotated
-    original_table = pd.read_csv(table_to_process, sep='\t', parse_dates=True)
-    original_table['tech'] = pd.Series([tech] * len(original_table))
+    # load root level table to be annotated, values as the strings they are in the TSV (empty cells as missing values),
+    # same as the chunked iter_ready_root_table_chunks, so that both upload a sheet the same way
+    original_table = pd.read_csv(table_to_process, sep='\t', dtype=str)
+    original_table['tech'] = tech
 
     # annotate root level table
     annotations, fc_uuid_2_fc_obj = annotate_nice_flowcells(original_table, column_name_conforming_to_naming_schema)
 
-    # then merge
-    original_table.drop(['tech'], axis=1, inplace=True)  # avoid tech_x, tech_y
-    annotated_root_table = original_table.merge(annotations, how='outer', indicator=True,
-                                                left_on=original_table.columns[0],
-                                                right_on=annotations.columns[0])
-    if any(annotated_root_table['_merge'] != 'both'):
-        problematic_entities = list(annotated_root_table[annotated_root_table['_merge'] != 'both'].iloc[:, 0])
-        raise ValueError(f"The annotation on nice flowcells don't fully agree with input flowcells: "
-                         f"  {problematic_entities}")
-    annotated_root_table.drop(['uuid', '_merge'], axis=1, inplace=True)
+    return __make_ready_root_table(original_table, annotations, tech), fc_uuid_2_fc_obj
+
+
+def iter_ready_root_table_chunks(table_to_process: str, tech: str, column_name_conforming_to_naming_schema: str,
+                                 chunk_size: int = INTAKE_CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    """
+    Chunked version of annotate_and_make_ready_root_table:
+    the table is read in chunks of rows, and each chunk is yielded annotated and ready for upload,
+    so that memory use is bounded by the chunk size instead of the size of the table.
+
+    Values are read as the strings they are in the TSV (empty cells as missing values),
+    instead of having their types inferred chunk by chunk,
+    so that a value is uploaded the same way whichever chunk it's in (e.g. never '5' in one chunk, '5.0' in another).
+    """
+
+    if not Path(table_to_process).is_file():
+        raise ValueError(f"Terra table TSV {table_to_process} doesn't seem to exist.")
+
+    with pd.read_csv(table_to_process, sep='\t', dtype=str, chunksize=chunk_size) as reader:
+        for original_chunk in reader:
+            original_chunk['tech'] = tech
+            annotations, _ = annotate_nice_flowcells(original_chunk, column_name_conforming_to_naming_schema)
+            yield __make_ready_root_table(original_chunk, annotations, tech)
+
+
+def annotate_and_upload_root_table_in_chunks(ns: str, ws: str,
+                                             table_to_process: str, tech: str,
+                                             column_name_conforming_to_naming_schema: str,
+                                             chunk_size: int = INTAKE_CHUNK_SIZE,
+                                             max_workers: int = 4,
+                                             checkpoint_file: str = None) -> pd.DataFrame:
+    """
+    Stream a (huge) local Terra table into a workspace:
+    each chunk of rows is annotated, made ready and uploaded (see table_utils.upload_table_chunks) as it is read,
+    and only the annotations needed for constructing the set level tables are kept in memory.
+    :param checkpoint_file: see table_utils.upload_table_chunks
+    :return: the ready root table, with only its uuid column and the annotations added to it,
+             which is enough for make_set_tables
+    """
+    annotation_columns = ['tech', 'tissue', 'extraction', 'participant']
+    kept = list()
+
+    def _keep_annotations(chunks: Iterator[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        for chunk in chunks:
+            kept.append(chunk[[chunk.columns[0]] + annotation_columns])
+            yield chunk
+
+    chunks = iter_ready_root_table_chunks(table_to_process, tech, column_name_conforming_to_naming_schema, chunk_size)
+    upload_table_chunks(ns, ws, _keep_annotations(chunks), job_name=f'{table_to_process}:{tech}:{chunk_size}',
+                        max_workers=max_workers, checkpoint_file=checkpoint_file)
+
+    return pd.concat(kept, ignore_index=True) if kept else \
+        pd.DataFrame(columns=[f'entity:{tech.lower()}-flowcell_id'] + annotation_columns)
+
+
+def __make_ready_root_table(original_table: pd.DataFrame, annotations: pd.DataFrame, tech: str) -> pd.DataFrame:
+    """
+    Attach the annotations, as provided by annotate_nice_flowcells on the same table, to the table,
+    and make the root entity type name tech specific.
+    """
+    # the annotations are parsed from the rows of the table itself, hence are already aligned with them
+    annotated_root_table = pd.concat([original_table.drop(columns=['tech']),  # avoid two tech columns
+                                      annotations.drop(columns=['uuid'])], axis=1)
 
     # change the root entity level name to be tech specific
     annotated_root_table.rename({'entity:flowcell_id': f'entity:{tech.lower()}-flowcell_id'}, axis=1, inplace=True)
 
-    return annotated_root_table, fc_uuid_2_fc_obj
+    return annotated_root_table
 
 
 def annotate_nice_flowcells(raw_data: pd.DataFrame, column_name_conforming_to_naming_schema: str) -> \
-        (pd.DataFrame, Dict[str, Flowcell]):
+        (pd.DataFrame, Mapping[str, Flowcell]):
     """
     Given a Terra data table with a column that conforms to a naming schema,
     returns a data frame with annotated flowcells.
@@ -92,25 +149,30 @@ def annotate_nice_flowcells(raw_data: pd.DataFrame, column_name_conforming_to_na
            following the pre-defined-pattern
     :return: a tuple-2 of :
               1) 5-col dataframe ['uuid', 'tech', 'tissue', 'extraction', 'participant'], where each row is one FC
-              2) a dictionary from flowcell uuid to flowcell object
+              2) a (read-only) mapping from flowcell uuid to flowcell object,
+                 where the flowcell objects are only constructed when looked up
     """
 
     minimum_column_names = ['entity:flowcell_id', 'tech', column_name_conforming_to_naming_schema]
     just_enough_columns = raw_data[minimum_column_names]
-    flowcells = just_enough_columns.apply(lambda row: Flowcell(row.iloc[0], row.iloc[1], row.iloc[2]),
-                                          axis=1)
+    uuids, techs, descriptions = [just_enough_columns.iloc[:, i] for i in range(3)]
 
-    annotated_flowcells = flowcells.apply(lambda fc:
-                                          pd.Series([fc.uuid, fc.tech, fc.tissue, fc.extraction, fc.parti_uuid]))
-    annotated_flowcells.columns = ['uuid', 'tech', 'tissue', 'extraction', 'participant']
+    # parse and validate the descriptions column-wise, instead of one Flowcell object per row
+    parsed = Flowcell.parse_flowcell_descriptions(descriptions)
 
-    fc_uuid_2_fc_obj = dict(zip(just_enough_columns.iloc[:, 0], flowcells))
+    annotated_flowcells = pd.DataFrame({'uuid': uuids,
+                                        'tech': techs,
+                                        'tissue': parsed['tissue'],
+                                        'extraction': parsed['extraction'],
+                                        'participant': parsed['participant']})
+
+    fc_uuid_2_fc_obj = LazyFlowcells(uuids, techs, descriptions,
+                                     parsed['participant'], parsed['extraction'], parsed['tissue'])
     return annotated_flowcells, fc_uuid_2_fc_obj
 
 
 ########################################################################################################################
-def make_set_tables(annotated_root_table: pd.DataFrame, tech: str, fc_uuid_2_fc_obj: Dict[str, Flowcell]) -> \
-        (Dict[str, pd.DataFrame], pd.DataFrame):
+def make_set_tables(annotated_root_table: pd.DataFrame, tech: str) -> (Dict[str, pd.DataFrame], pd.DataFrame):
     """
     Given an annotated root level table,
     :return: a dict of tables where the key is the criteria (actually the value under this criteria), and
@@ -119,34 +181,36 @@ def make_set_tables(annotated_root_table: pd.DataFrame, tech: str, fc_uuid_2_fc_
     """
 
     # name of the mega set table uuid column, and members column
-    mega_set_entity_type_col_name = f'entity:{tech}-sample_id'
+    mega_set_entity_type_col_name = f'entity:{tech}-mega-sample_id'
     member_type_col_name = re.sub('entity:', '', re.sub('_id$', '', annotated_root_table.columns[0])) + 's'
 
     # key: the value under classification criteria, value: the set level table
     classified_tables = dict()
     # all those tables in the dict above concatenated by row, with one extra column signalling generated by which criteria
-    flowcell_mega_set_table = pd.DataFrame()
+    # (columns are collected across all tables, and the mega table is constructed once at the end)
+    mega_set_columns = ([], [], [], [])
 
     # this only holds root entity ids as list
-    entity_mega_sets = classify_root_entities(annotated_root_table, fc_uuid_2_fc_obj)
+    entity_mega_sets = classify_root_entities(annotated_root_table)
     for level in entity_mega_sets.keys():
         for classifier in entity_mega_sets[level].keys():
             for value in entity_mega_sets[level][classifier].keys():
 
-                samples_df = __turn_samples_to_formatted_table(entity_mega_sets, level, classifier, value,
-                                                               member_type_col_name)
-
-                classified_tables[value] = samples_df
+                columns = __turn_samples_to_formatted_table(entity_mega_sets, level, classifier, value)
 
-                old = samples_df.columns[0]
-                new = f"entity:{tech}-mega-sample_id"
-                new_rows = samples_df.rename({old: new}, axis=1)
-                flowcell_mega_set_table = flowcell_mega_set_table.append(new_rows, ignore_index=True)
+                classified_tables[value] = pd.DataFrame(dict(zip([f"entity:{value}-sample_id", member_type_col_name,
+                                                                  'classifier', 'participant'],
+                                                                 columns)))
+                for collected, column in zip(mega_set_columns, columns):
+                    collected.extend(column)
 
+    flowcell_mega_set_table = pd.DataFrame(dict(zip([mega_set_entity_type_col_name, member_type_col_name,
+                                                     'classifier', 'participant'],
+                                                    mega_set_columns)))
     return classified_tables, flowcell_mega_set_table
 
 
-def classify_root_entities(annotated_root_table: pd.DataFrame, fc_uuid_2_fc_obj: Dict[str, Flowcell]) -> \
+def classify_root_entities(annotated_root_table: pd.DataFrame) -> \
         Dict[str,
              Dict[str,
                   Dict[str, List[Sample]]]]:
@@ -158,54 +222,65 @@ def classify_root_entities(annotated_root_table: pd.DataFrame, fc_uuid_2_fc_obj:
     and underneath that, is another dict whose keys are the unique values of this factor,
     and values are corresponding samples.
 
-    The 'level-two' dict is similarly defined, except flowcells are now classified using two criteria.
+    The 'level-two' dict is similarly defined, except flowcells are now classified using two criteria,
+    and only the combinations of values that some flowcells actually have are kept.
+    :param annotated_root_table:
     :return:
     """
 
     set_dictionary = {'level_one': dict(),
                       'level_two': dict()}
 
+    # flowcells are grouped by the annotation columns, so samples are built from these columns, without Flowcell objects
+    fc_uuids = annotated_root_table.iloc[:, 0].tolist()
+    participants = annotated_root_table['participant'].tolist()
+
     level_one_dict = dict.fromkeys(SELECTION_CRITERION)
     for c in SELECTION_CRITERION:
-        level_one_dict[c] = dict()
-        for u in annotated_root_table[c].unique():  # unique values under this selection criterion
-            # by definition, 1 sample per participant for a specified criterion
-            member_fc_uuids = annotated_root_table[annotated_root_table[c] == u].iloc[:, 0].tolist()
-            classifier_names_and_values = [(c, u)]
-            fc_objects = [fc_uuid_2_fc_obj.get(uuid) for uuid in member_fc_uuids]
-            participant_2_fcs = dict()  # dict.fromkeys(set([fc.parti_uuid for fc in fc_objects]))  # group by participant
-            for fc in fc_objects:
-                participant_2_fcs.setdefault(fc.parti_uuid, []).append(fc)
-            samples = [Sample(fcs, classifier_names_and_values) for p, fcs in participant_2_fcs.items()]
-            level_one_dict[c][u] = samples
+        samples = __group_into_samples(annotated_root_table, [c], fc_uuids, participants)
+        level_one_dict[c] = {values[0]: sms for values, sms in samples.items()}
     set_dictionary['level_one'] = level_one_dict
 
     level_two_dict = dict()
     for c in SELECTION_CRITERIA:
-        k1 = '_'.join(c)
-        level_two_dict[k1] = dict()
-        p1 = annotated_root_table[c[0]].unique()  # unique values under selection criterion 1
-        p2 = annotated_root_table[c[1]].unique()  # unique values under selection criterion 2
-        for comb in itertools.product(p1, p2):  # essentially a nested loop
-            k2 = '_'.join(comb)
-            a = annotated_root_table[c[0]] == comb[0]
-            b = annotated_root_table[c[1]] == comb[1]
-            member_fc_uuids = annotated_root_table[a & b].iloc[:, 0].tolist()
-            classifier_names_and_values = [(c[0], comb[0]), (c[1], comb[1])]
-            fc_objects = [fc_uuid_2_fc_obj.get(uuid) for uuid in member_fc_uuids]
-            participant_2_fcs = dict()  # dict.fromkeys(set([fc.parti_uuid for fc in fc_objects]))  # group by participant
-            for fc in fc_objects:
-                participant_2_fcs.setdefault(fc.parti_uuid, []).append(fc)
-            samples = [Sample(fcs, classifier_names_and_values) for p, fcs in participant_2_fcs.items()]
-            level_two_dict[k1][k2] = samples
+        samples = __group_into_samples(annotated_root_table, list(c), fc_uuids, participants)
+        # order the (non-empty) combinations as a nested loop over the unique values under the two criteria would
+        ranks = [{u: i for i, u in enumerate(annotated_root_table[k].unique())} for k in c]
+        level_two_dict['_'.join(c)] = {'_'.join(comb): samples[comb]
+                                       for comb in sorted(samples, key=lambda t: (ranks[0][t[0]], ranks[1][t[1]]))}
     set_dictionary['level_two'] = level_two_dict
 
     return set_dictionary
 
 
+def __group_into_samples(annotated_root_table: pd.DataFrame, criteria: List[str],
+                         fc_uuids: List[str], participants: List[str]) -> Dict[tuple, List[Sample]]:
+    """
+    Group flowcells by the values under the given criteria, then by participant,
+    as by definition, there is 1 sample per participant for the specified criteria.
+    :param fc_uuids: the uuid column of the table
+    :param participants: the participant column of the table
+    :return: {values under the criteria: samples}, holding only the combinations of values that actually occur,
+             in order of their first appearance
+    """
+    groups = annotated_root_table.groupby(criteria).indices  # {values under the criteria: row positions}
+
+    samples = dict()
+    for values in sorted(groups, key=lambda k: groups[k][0]):
+        positions = groups[values]
+        values = values if isinstance(values, tuple) else (values,)
+        classifier_names_and_values = list(zip(criteria, values))
+
+        participant_2_fcs = dict()  # group by participant, in order of first appearance
+        for i in positions.tolist():
+            participant_2_fcs.setdefault(participants[i], []).append(fc_uuids[i])
+        samples[values] = [Sample.from_grouped_flowcells(p, tuple(fcs), classifier_names_and_values)
+                           for p, fcs in participant_2_fcs.items()]
+    return samples
+
+
 def __turn_samples_to_formatted_table(entity_mega_sets: Dict[str, Dict[str, Dict[str, List[Sample]]]],
-                                      level: str, classifier: str, value: str,
-                                      member_type_col_name: str) -> pd.DataFrame:
+                                      level: str, classifier: str, value: str) -> Tuple[list, list, list, list]:
 
     """
     Given a particular triplet of (level, classifier, and value), gather the samples in entity_mega_sets
@@ -213,14 +288,14 @@ def __turn_samples_to_formatted_table(entity_mega_sets: Dict[str, Dict[str, Dict
     :param level:
     :param classifier:
     :param value:
-    :param member_type_col_name:
-    :return:
+    :return: columns of the formatted table, i.e. tuple 4 of (sample uuids, member flowcell uuids, classifier names,
+             participant uuids)
     """
     samples_in_this_table = entity_mega_sets[level][classifier][value]
-    data = [(sm.uuid, sm.flowcells_uuid, classifier, sm.parti_uuid) for sm in samples_in_this_table]
-    samples_table = pd.DataFrame.from_records(data,
-                                              columns=[f"entity:{value}-sample_id", member_type_col_name,
-                                                       'classifier', 'participant'])
+    samples_table = ([sm.uuid for sm in samples_in_this_table],
+                     [list(sm.flowcells_uuid) for sm in samples_in_this_table],
+                     [classifier] * len(samples_in_this_table),
+                     [sm.parti_uuid for sm in samples_in_this_table])
 
     # participant_2_sm_list = dict()  # group by participant
     # for sample in entity_mega_sets[level][classifier][value]:
@@ -246,7 +321,9 @@ def construct_bare_family_table_from_individual_table(individual_fc_table: pd.Da
                                                       flowcell_id_col: str,
                                                       group_by: str,
                                                       family_id_col: str,
-                                                      relation_col: str) -> pd.DataFrame:
+                                                      relation_col: str,
+                                                      membership_as_long_table: bool = False) \
+        -> pd.DataFrame or (pd.DataFrame, pd.DataFrame):
     """
     Supporting a common usage scenario:
       Each member of families may have multiple flowcells, we want to group together the multiple FC's by individual,
@@ -256,14 +333,27 @@ def construct_bare_family_table_from_individual_table(individual_fc_table: pd.Da
     :param group_by: the column name that identifies which individual this flowcell belongs to
     :param family_id_col: the column name that identifies which family this individual belongs to
     :param relation_col: the column name that identifies the relation within the family of the individual
-    :return:
+    :param membership_as_long_table: if True, instead of holding the flowcells of each individual as a list,
+                                     return them separately as a 2-col [group_by, flowcell_id_col] table,
+                                     one row per flowcell, which is the shape of a membership TSV for bulk upload
+    :return: one row per individual, sorted by individual, with family and relation taken from its first flowcell;
+             if membership_as_long_table, a tuple 2 of (that table without the flowcell column, the membership table)
     """
-    multi_fc_individual_table = individual_fc_table\
-        .groupby(group_by)\
-        .agg({group_by: lambda x: x.tolist()[0],
-              flowcell_id_col: lambda x: x.tolist(),
-              family_id_col: lambda x: x.tolist()[0],
-              relation_col: lambda x: x.tolist()[0]})\
+    # sorted by individual, keeping the original order of flowcells of the same individual
+    table = individual_fc_table[individual_fc_table[group_by].notna()].sort_values(group_by, kind='stable')
+
+    # the first row of each individual, as is (i.e. not skipping missing values, as groupby().first() would)
+    multi_fc_individual_table = table[[group_by, family_id_col, relation_col]]\
+        .drop_duplicates(subset=group_by, keep='first')\
         .reset_index(drop=True)
 
+    if membership_as_long_table:
+        return multi_fc_individual_table, table[[group_by, flowcell_id_col]].reset_index(drop=True)
+
+    # rows of each individual are contiguous, so the flowcell lists are consecutive slices of the flowcell column
+    individuals = table[group_by].to_numpy()
+    boundaries = np.flatnonzero(individuals[1:] != individuals[:-1]) + 1
+    flowcells = np.split(table[flowcell_id_col].to_numpy(), boundaries) if len(table) else []
+    multi_fc_individual_table.insert(1, flowcell_id_col, [fcs.tolist() for fcs in flowcells])
+
     return multi_fc_individual_table
@@ -5,11 +5,11 @@ import logging
 from typing import List, Dict, Tuple
 
 import pytz
-from dateutil import parser
 from firecloud import api as fapi
 from firecloud.errors import FireCloudServerError
 
 from ..table_utils import add_one_set
+from ...utils import parse_iso_timestamp, parse_iso_timestamps
 
 ########################################################################################################################
 
@@ -315,12 +315,14 @@ def get_submissions_for_workflow(ns: str, ws: str, workflow: str, days_back: int
         logger.error(f"Failed to list submissions in workspace {ns}/{ws}.")
         raise FireCloudServerError(response.status_code, response.text)
 
-    all_submissions = sorted(response.json(), key=lambda sub: parser.parse(sub['submissionDate']))
+    all_submissions = response.json()
+    submission_dates = parse_iso_timestamps(sub['submissionDate'] for sub in all_submissions)
     cut_off_date = datetime.datetime.utcnow().astimezone(datetime.timezone.utc) - datetime.timedelta(days=days_back)
-    drill_down = [sub for sub in all_submissions if
-                  parser.parse(sub['submissionDate']) > cut_off_date
-                  and sub['methodConfigurationName'] == workflow]
-    return drill_down
+    drill_down = sorted([(date, sub) for date, sub in zip(submission_dates, all_submissions) if
+                         date > cut_off_date
+                         and sub['methodConfigurationName'] == workflow],
+                        key=lambda t: t[0])
+    return [sub for _, sub in drill_down]
 
 
 def _collect_entities_and_statuses(ns: str, ws: str, workflow: str, etype: str, relevant_submissions: List[dict]) \
@@ -352,7 +354,7 @@ def _collect_entities_and_statuses(ns: str, ws: str, workflow: str, etype: str,
                 logger.error(f"Failed to get submission {sub['submissionId']} in workspace {ns}/{ws}.")
                 raise FireCloudServerError(response.status_code, response.text)
             detailed = response.json()
-            timing = parser.parse(detailed['workflows'][0]['statusLastChangedDate'])
+            timing = parse_iso_timestamp(detailed['workflows'][0]['statusLastChangedDate'])
             if 'Succeeded' == detailed['workflows'][0]['status']:
                 succ.append((e, timing))
             elif 'Failed' == detailed['workflows'][0]['status']:
@@ -407,9 +409,10 @@ def get_entities_in_a_batch(ns: str, ws: str, submission_id: str) -> \
     success = list()
     failure = list()
     running = list()
-    for w in batch_submission_json['workflows']:
+    workflows = batch_submission_json['workflows']
+    timings = parse_iso_timestamps(w['statusLastChangedDate'] for w in workflows)
+    for w, t in zip(workflows, timings):
         e = w['workflowEntity']['entityName']
-        t = parser.parse(w['statusLastChangedDate'])
         if 'Failed' == w['status']:
             failure.append((e, t))
         elif 'Succeeded' == w['status']:
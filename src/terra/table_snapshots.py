@@ -0,0 +1,135 @@
+import datetime
+import json
+import logging
+import os
+from typing import List
+
+import pandas as pd
+from pyarrow import feather
+
+from .table_utils import fetch_existing_root_table_typed, format_attribute_for_tsv
+
+logger = logging.getLogger(__name__)
+
+
+########################################################################################################################
+class TableSnapshotStore:
+    """
+    Local, columnar (Arrow IPC/Feather) snapshots of Terra tables,
+    so that analyses re-reading the same table don't have to fetch it from the API every time.
+
+    Each snapshot is kept typed (see table_utils.apply_column_types), uncompressed so that it can be memory-mapped,
+    next to a JSON manifest holding when it was fetched and how many entities it holds.
+
+    Terra's entity API offers no way to fetch only entities modified since a given time,
+    so refresh(...) fetches the full table and diffs it against the snapshot,
+    re-writing the snapshot only if anything changed.
+    """
+
+    def __init__(self, root_dir: str):
+        self.root_dir = root_dir
+        os.makedirs(self.root_dir, exist_ok=True)
+
+    def load(self, ns: str, ws: str, etype: str,
+             column_types: List[dict] = None,
+             max_age: datetime.timedelta = None) -> pd.DataFrame:
+        """
+        Load a table from its snapshot, fetching it (and snapshotting it) first if there's no (fresh enough) snapshot.
+
+        :param ns:
+        :param ws:
+        :param etype: e.g. 'flowcell`
+        :param column_types: see table_utils.apply_column_types(...); used only when the table is to be fetched
+        :param max_age: if provided, a snapshot older than this is refreshed
+        :return: DataFrame where the first column is named as what you see as the table name on Terra
+        """
+        manifest = self.manifest(ns, ws, etype)
+        if manifest is None:
+            return self.refresh(ns, ws, etype, column_types)
+        if max_age is not None:
+            fetch_time = datetime.datetime.fromisoformat(manifest['fetch_time'])
+            if datetime.datetime.now(tz=datetime.timezone.utc) - fetch_time > max_age:
+                return self.refresh(ns, ws, etype, column_types)
+
+        return feather.read_table(self.__table_path(ns, ws, etype), memory_map=True).to_pandas()
+
+    def refresh(self, ns: str, ws: str, etype: str, column_types: List[dict] = None) -> pd.DataFrame:
+        """
+        Fetch the table from Terra, and update its snapshot if anything changed.
+        :return: the freshly fetched table
+        """
+        fetch_time = datetime.datetime.now(tz=datetime.timezone.utc)
+        table = TableSnapshotStore.__arrow_friendly(
+            fetch_existing_root_table_typed(ns, ws, etype, column_types or list()))
+
+        previous = self.manifest(ns, ws, etype)
+        changed = None
+        if previous is not None:
+            old = feather.read_table(self.__table_path(ns, ws, etype), memory_map=True).to_pandas()
+            changed = TableSnapshotStore.__count_changed_entities(old, table)
+            logger.info(f"Table {etype} in {ns}/{ws}: {changed} entities added, removed or changed since "
+                        f"the snapshot taken at {previous['fetch_time']}.")
+
+        if changed != 0:
+            self.__write_atomically(self.__table_path(ns, ws, etype),
+                                    lambda p: feather.write_feather(table, p, compression='uncompressed'))
+        manifest = {'namespace': ns, 'workspace': ws, 'etype': etype,
+                    'fetch_time': fetch_time.isoformat(),
+                    'entity_count': len(table),
+                    'columns': {c: str(t) for c, t in table.dtypes.items()}}
+        self.__write_atomically(self.__manifest_path(ns, ws, etype),
+                                lambda p: TableSnapshotStore.__write_json(manifest, p))
+        return table
+
+    def manifest(self, ns: str, ws: str, etype: str) -> dict or None:
+        """
+        :return: manifest of the snapshot of the requested table, None if there isn't one
+        """
+        path = self.__manifest_path(ns, ws, etype)
+        if not (os.path.isfile(path) and os.path.isfile(self.__table_path(ns, ws, etype))):
+            return None
+        with open(path) as fh:
+            return json.load(fh)
+
+    ####################################################################################################################
+    def __table_path(self, ns: str, ws: str, etype: str) -> str:
+        return os.path.join(self.root_dir, ns, ws, f'{etype}.arrow')
+
+    def __manifest_path(self, ns: str, ws: str, etype: str) -> str:
+        return os.path.join(self.root_dir, ns, ws, f'{etype}.manifest.json')
+
+    @staticmethod
+    def __write_atomically(path: str, write) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = f'{path}.{os.getpid()}.part'
+        write(partial)
+        os.replace(partial, path)
+
+    @staticmethod
+    def __write_json(d: dict, path: str) -> None:
+        with open(path, 'w') as fh:
+            json.dump(d, fh, indent=2)
+
+    @staticmethod
+    def __arrow_friendly(table: pd.DataFrame) -> pd.DataFrame:
+        """
+        Untyped columns may hold a mix of strings, numbers and JSON-like values (lists, references),
+        which Arrow can't store in one column; these are stored as strings.
+        """
+        for c in table.columns:
+            if pd.api.types.is_object_dtype(table[c]):
+                table[c] = table[c].map(format_attribute_for_tsv).astype('string')
+        return table
+
+    @staticmethod
+    def __count_changed_entities(old: pd.DataFrame, new: pd.DataFrame) -> int:
+        if list(old.columns) != list(new.columns):
+            return max(len(old), len(new))
+        id_col = new.columns[0]
+        old_rows = old.set_index(id_col).astype('string')
+        new_rows = new.set_index(id_col).astype('string')
+        common = old_rows.index.intersection(new_rows.index)
+        differing = old_rows.loc[common].ne(new_rows.loc[common]) & \
+            ~(old_rows.loc[common].isna() & new_rows.loc[common].isna())
+        return int(differing.fillna(True).any(axis=1).sum()) \
+            + len(old_rows.index.difference(new_rows.index)) + len(new_rows.index.difference(old_rows.index))
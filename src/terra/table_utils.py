@@ -1,7 +1,15 @@
+import ast
+import hashlib
+import json
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+from typing import Dict, Iterable, Tuple
 
+import numpy as np
 import pandas as pd
+import requests
 from firecloud import api as fapi
 from firecloud.errors import FireCloudServerError
 
@@ -11,6 +19,10 @@ logger = logging.getLogger(__name__)
 
 ROOT_LEVEL_TABLE = 'The table in a workspace that represents the smallest analyzable unit of data, e.g. a flowcell.'
 
+ENTITY_PAGE_SIZE = 1000  # number of entities fetched per request when streaming a table
+UPLOAD_CHUNK_SIZE = 1000  # number of rows uploaded per request when uploading a table in chunks
+UPLOAD_MAX_RETRIES = 3  # number of times a failed chunk is retried
+
 
 ########################################################################################################################
 def fetch_existing_root_table(ns: str, ws: str, etype: str) -> pd.DataFrame:
@@ -27,11 +39,97 @@ def fetch_existing_root_table(ns: str, ws: str, etype: str) -> pd.DataFrame:
         logger.error(f"Table {etype} doesn't seem to exist in workspace {ns}/{ws}.")
         raise FireCloudServerError(response.status_code, response.text)
 
-    entities = [e.get('name') for e in response.json()]
-    entity_type = [e.get('entityType') for e in response.json()][0]
-    attributes = pd.DataFrame.from_dict([e.get('attributes') for e in response.json()]).sort_index(axis=1).astype('str')
-    attributes.insert(0, column=entity_type, value=entities)
-    return attributes.copy(deep=True)
+    entities = response.json()
+    entity_type = entities[0].get('entityType')
+    names = [e.get('name') for e in entities]
+
+    # build the frame directly from the entity list, with its columns already sorted,
+    # and let go of the parsed response before casting the frame in one pass;
+    # dtypes are inferred before the cast, as they always were, so e.g. an int attribute missing on some
+    # entities still reads '5.0'
+    attributes = [e.get('attributes') for e in entities]
+    del entities
+    table = pd.DataFrame(attributes, columns=sorted(set().union(*attributes)))
+    del attributes
+    table = table.astype('str')
+    table.insert(0, column=entity_type, value=names)
+    return table
+
+
+def fetch_existing_root_table_typed(ns: str, ws: str, etype: str,
+                                    column_types: List[dict],
+                                    auto_categorize_threshold: float = None) -> pd.DataFrame:
+    """
+    Same as fetch_existing_root_table, except that, instead of forcing every column to str,
+    columns are converted (whole columns at a time) to the requested types when loaded.
+
+    :param ns:
+    :param ws:
+    :param etype: e.g. 'flowcell`
+    :param column_types: see apply_column_types(...)
+    :param auto_categorize_threshold: see apply_column_types(...)
+    :return: DataFrame where the first column is named as what you see as the table name on Terra
+    """
+    response = fapi.get_entities(ns, ws, etype=etype)
+    if not response.ok:
+        logger.error(f"Table {etype} doesn't seem to exist in workspace {ns}/{ws}.")
+        raise FireCloudServerError(response.status_code, response.text)
+
+    entities = response.json()
+    attributes = pd.DataFrame.from_records([e.get('attributes') for e in entities]).sort_index(axis=1)
+    attributes = apply_column_types(attributes, column_types, auto_categorize_threshold)
+    attributes.insert(0, column=etype, value=[e.get('name') for e in entities])
+    return attributes
+
+
+def apply_column_types(table: pd.DataFrame, column_types: List[dict],
+                       auto_categorize_threshold: float = None) -> pd.DataFrame:
+    """
+    Convert, in place, columns of a table to the requested types, one vectorized conversion per column.
+
+    :param table: table to convert
+    :param column_types: list of specs, each of the form {'type': ..., 'columns': [...]}, where type is one of
+                         'bool' (true if the value reads 'true', case-insensitive),
+                         'Int64' (nullable integers, rounded), 'float64', 'category',
+                         'datetime64' (parsed as ISO-8601, in UTC or in spec['timezone'] if given; NaT if unparsable),
+                         or any other type accepted by DataFrame.astype;
+                         values that can't be converted to numbers become missing values
+    :param auto_categorize_threshold: if given, the remaining string columns whose ratio of distinct values to
+                                      rows is at most this threshold are turned into categoricals
+    :return: the converted table
+    """
+    specified = set()
+    for spec in column_types:
+        t = spec['type']
+        for c in spec['columns']:
+            if c not in table.columns:
+                logger.warning(f"Column {c} isn't in the table, so can't be converted to {t}.")
+                continue
+            specified.add(c)
+            col = table[c]
+            if 'bool' == t:
+                table[c] = col.astype(str).str.lower().eq('true')
+            elif t in ('Int64', 'float64'):
+                numbers = pd.to_numeric(col, errors='coerce')
+                table[c] = numbers.round().astype('Int64') if 'Int64' == t else numbers.astype('float64')
+            elif t.startswith('datetime64'):
+                parsed = pd.to_datetime(col, utc=True, errors='coerce', format='ISO8601')
+                table[c] = parsed.dt.tz_convert(spec['timezone']) if spec.get('timezone') else parsed
+            else:
+                table[c] = col.astype(t)
+
+    if auto_categorize_threshold is not None and 0 < len(table):
+        for c in table.columns:
+            if c in specified or not (pd.api.types.is_object_dtype(table[c]) or
+                                      pd.api.types.is_string_dtype(table[c])):
+                continue
+            try:
+                distinct = table[c].nunique(dropna=True)
+            except TypeError:  # unhashable values, e.g. lists or references
+                continue
+            if distinct <= auto_categorize_threshold * len(table):
+                table[c] = table[c].astype('category')
+    return table
 
 
 def upload_root_table(ns: str, ws: str, table: pd.DataFrame) -> None:
@@ -53,6 +151,124 @@ def upload_root_table(ns: str, ws: str, table: pd.DataFrame) -> None:
         raise FireCloudServerError(response.status_code, response.text)
 
 
+def upload_root_table_in_chunks(ns: str, ws: str, table: pd.DataFrame,
+                                chunk_size: int = UPLOAD_CHUNK_SIZE,
+                                max_workers: int = 4,
+                                max_retries: int = UPLOAD_MAX_RETRIES,
+                                checkpoint_file: str = None) -> None:
+    """
+    Same as upload_root_table, but for large tables:
+    the table is uploaded in chunks of rows, concurrently, and each failed chunk is retried on its own.
+
+    If checkpoint_file is provided, uploaded chunks are recorded there,
+    and re-running the same upload after a failure/interruption only uploads the remaining chunks.
+    """
+    n = table.columns.tolist()[0]
+    if not (n.startswith('entity:') and n.endswith('_id')):
+        raise ValueError(f"Input table's 1st column name doesn't follow Terra's requirements: {n}")
+
+    chunks = (table.iloc[start:start + chunk_size] for start in range(0, len(table), chunk_size))
+    upload_table_chunks(ns, ws, chunks, job_name=f'{n}:{len(table)}:{chunk_size}',
+                        max_workers=max_workers, max_retries=max_retries, checkpoint_file=checkpoint_file)
+
+
+def upload_table_chunks(ns: str, ws: str, chunks: Iterable[pd.DataFrame],
+                        job_name: str,
+                        max_workers: int = 4,
+                        max_retries: int = UPLOAD_MAX_RETRIES,
+                        checkpoint_file: str = None) -> None:
+    """
+    Upload a stream of TSV-ready tables (root, set, or membership; all columns in the format Terra expects),
+    concurrently, with retries per chunk, and optionally recording progress in a checkpoint file.
+
+    Chunks are identified by their position in the stream, so resuming requires re-generating the same stream.
+    Only a bounded number of chunks are held in memory at any time.
+    :param ns:
+    :param ws:
+    :param chunks: tables to be uploaded
+    :param job_name: identifies the upload job in the checkpoint file
+    :param max_workers: number of chunks uploaded concurrently
+    :param max_retries: number of times a failed chunk is retried
+    :param checkpoint_file: local JSON file recording uploaded chunks, if provided
+    :return:
+    """
+    checkpoint = _load_checkpoint(checkpoint_file, {'job': f'{ns}/{ws}/{job_name}'}) if checkpoint_file else None
+    done = set(checkpoint['completed']) if checkpoint else set()
+
+    failures = list()
+
+    def _record(i: int, future) -> None:
+        try:
+            future.result()
+        except Exception as e:  # keep going with the other chunks, so that a rerun only redoes failed ones
+            failures.append((i, e))
+            return
+        if checkpoint is not None:
+            checkpoint['completed'].append(i)
+            _save_checkpoint(checkpoint_file, checkpoint)
+
+    pending = dict()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for i, chunk in enumerate(chunks):
+            if i in done:
+                continue
+            pending[i] = pool.submit(_upload_one_chunk, ns, ws, chunk, max_retries)
+            if len(pending) >= 2 * max_workers:  # back-pressure: don't pull in more chunks than can be uploaded soon
+                oldest = min(pending)
+                _record(oldest, pending.pop(oldest))
+        for i in sorted(pending):
+            _record(i, pending[i])
+    if failures:
+        logger.error(f"Failed to upload chunks {[i for i, _ in failures]} of {job_name} to workspace {ns}/{ws}.")
+        raise failures[0][1]
+    logger.info(f"Uploaded {job_name} to workspace {ns}/{ws}.")
+
+
+def _upload_one_chunk(ns: str, ws: str, chunk: pd.DataFrame, max_retries: int, delete_empty: bool = False) -> None:
+    n = chunk.columns.tolist()[0]
+    entity_data = chunk.to_csv(sep='\t', index=False)
+    for attempt in range(1 + max_retries):
+        try:
+            response = fapi.upload_entities(namespace=ns, workspace=ws, entity_data=entity_data, model='flexible',
+                                            delete_empty=delete_empty)
+        except requests.RequestException as e:  # connection errors and timeouts are as retryable as server errors
+            response, error = None, e
+        else:
+            if response.ok:
+                return
+            error = response.status_code
+        logger.warning(f"Attempt {1 + attempt} to upload {len(chunk)} rows of table {n}"
+                       f" to workspace {ns}/{ws} failed: {error}")
+        if attempt < max_retries:
+            time.sleep(2 ** attempt)
+    logger.error(f"Failed to upload rows starting with {chunk.iloc[0, 0]} of table {n} to workspace {ns}/{ws}.")
+    if response is None:
+        raise error
+    raise FireCloudServerError(response.status_code, response.text)
+
+
+def _load_checkpoint(checkpoint_file: str, identity: dict) -> dict:
+    """
+    Load the progress recorded in a checkpoint file, or start a fresh one.
+    :param identity: describes the job; a checkpoint recorded for a different job is refused
+    """
+    if not os.path.isfile(checkpoint_file):
+        return dict(identity, completed=list())
+    with open(checkpoint_file) as fh:
+        checkpoint = json.load(fh)
+    if any(checkpoint.get(k) != v for k, v in identity.items()):
+        raise ValueError(f"Checkpoint file {checkpoint_file} was recorded for a different job: {checkpoint}")
+    logger.info(f"Resuming from checkpoint {checkpoint_file}: {len(checkpoint['completed'])} units of work done.")
+    return checkpoint
+
+
+def _save_checkpoint(checkpoint_file: str, checkpoint: dict) -> None:
+    partial = f'{checkpoint_file}.part'
+    with open(partial, 'w') as fh:
+        json.dump(checkpoint, fh)
+    os.replace(partial, checkpoint_file)
+
+
 ########################################################################################################################
 class MembersOperationType(Enum):
     RESET = 1  # remove old members and fill with with new members
@@ -104,6 +320,65 @@ def upload_set_table(ns: str, ws: str, table: pd.DataFrame,
             raise
 
 
+def upload_set_tables_in_chunks(ns: str, ws: str, set_tables: List[pd.DataFrame], membership_col_name: str,
+                                chunk_size: int = UPLOAD_CHUNK_SIZE,
+                                max_workers: int = 4,
+                                max_retries: int = UPLOAD_MAX_RETRIES,
+                                checkpoint_file: str = None) -> None:
+    """
+    Upload several set level tables together, in chunks of rows, concurrently (see upload_table_chunks):
+    first the sets with their other attributes, then their members, in bulk, as membership TSVs,
+    instead of one update_entity call per set as upload_set_table does.
+
+    Members are added to the existing ones, if any, i.e. as MembersOperationType.MERGE does.
+    :param ns:
+    :param ws:
+    :param set_tables: tables whose 1st column is named as f"entity:{set_type}_id"
+    :param membership_col_name: name of the column, in each table, holding the list of members;
+                                the member type is resolved from it, e.g. 'samples' -> 'sample'
+    :param chunk_size: number of rows per upload request
+    :param max_workers: see upload_table_chunks
+    :param max_retries: see upload_table_chunks
+    :param checkpoint_file: see upload_table_chunks; progress of the two stages (sets, then members)
+                            is recorded in two files named after it,
+                            e.g. 'ckpt.json' -> 'ckpt.sets.json' and 'ckpt.members.json'
+    :return:
+    """
+    for t in set_tables:
+        n = t.columns.tolist()[0]
+        if not (n.startswith('entity:') and n.endswith('_id')):
+            raise ValueError(f"Input table's 1st column name doesn't follow Terra's requirements: {n}")
+    member_entity_type = _resolve_member_type(membership_col_name)
+
+    def _set_chunks() -> Iterable[pd.DataFrame]:
+        for table in set_tables:
+            for start in range(0, len(table), chunk_size):
+                yield table.iloc[start:start + chunk_size].drop(columns=[membership_col_name])
+
+    def _membership_chunks() -> Iterable[pd.DataFrame]:
+        for table in set_tables:
+            set_type = re.sub('^entity:', '', re.sub('_id$', '', table.columns[0]))
+            membership = pd.DataFrame.from_records(
+                [(s, m) for s, members in zip(table.iloc[:, 0], table[membership_col_name]) for m in members],
+                columns=[f'membership:{set_type}_id', member_entity_type])
+            for start in range(0, len(membership), chunk_size):
+                yield membership.iloc[start:start + chunk_size]
+
+    def _stage_checkpoint(stage: str) -> str or None:
+        if not checkpoint_file:
+            return None
+        base, ext = os.path.splitext(checkpoint_file)
+        return f'{base}.{stage}{ext}'
+
+    # two separate jobs, so that no membership is uploaded before all the sets themselves are
+    tables_signature = hashlib.sha1(','.join(f'{t.columns[0]}:{len(t)}' for t in set_tables).encode()).hexdigest()[:12]
+    job_name = f'{len(set_tables)} set tables ({tables_signature}):{chunk_size}'
+    upload_table_chunks(ns, ws, _set_chunks(), job_name=f'{job_name}:sets',
+                        max_workers=max_workers, max_retries=max_retries, checkpoint_file=_stage_checkpoint('sets'))
+    upload_table_chunks(ns, ws, _membership_chunks(), job_name=f'{job_name}:members',
+                        max_workers=max_workers, max_retries=max_retries, checkpoint_file=_stage_checkpoint('members'))
+
+
 def format_set_table_ready_for_upload(set_table: pd.DataFrame,
                                       current_set_type_name: str, desired_set_type_name: str,
                                       membership_col_name: str) \
@@ -118,13 +393,10 @@ def format_set_table_ready_for_upload(set_table: pd.DataFrame,
     :return: a formatted table that is ready to be uploaded to Terra via API calls sans the membership column,
              which is returned as the 2nd value in the returned tuple
     """
-    col = set_table.pop(current_set_type_name)
-    formatted_set_table = set_table.copy(deep=True)
-    formatted_set_table.insert(0, f"entity:{desired_set_type_name}_id", col)
-
-    members = formatted_set_table[membership_col_name].tolist()
+    members = set_table[membership_col_name].tolist()
 
-    formatted_set_table.drop([membership_col_name], axis=1, inplace=True)
+    formatted_set_table = set_table.drop(columns=[current_set_type_name, membership_col_name])
+    formatted_set_table.insert(0, f"entity:{desired_set_type_name}_id", set_table[current_set_type_name].values)
 
     return formatted_set_table, members
 
@@ -229,15 +501,19 @@ def fetch_and_format_existing_set_table(ns: str, ws: str, etype: str, member_col
     """
     # fetch and keep all attributes in original table
     response = fapi.get_entities(ns, ws, etype=etype)
+    if not response.ok:
+        logger.error(f"Table {etype} doesn't seem to exist in workspace {ns}/{ws}.")
+        raise FireCloudServerError(response.status_code, response.text)
+    entities = response.json()
 
-    entities = pd.Series([e.get('name') for e in response.json()], name=f"entity:{etype}_id")
-    attributes = pd.DataFrame.from_dict([e.get('attributes') for e in response.json()])
+    attributes = pd.DataFrame.from_records([e.get('attributes') for e in entities])
 
     # re-format the membership column, otherwise uploading will cause problems
-    x = attributes[member_column_name].apply(lambda d: [e.get('entityName') for e in d.get('items')])
-    attributes[member_column_name] = x
+    attributes[member_column_name] = [[m.get('entityName') for m in d.get('items')]
+                                      for d in attributes[member_column_name]]
+    attributes.insert(0, f"entity:{etype}_id", [e.get('name') for e in entities])
 
-    return pd.concat([entities, attributes], axis=1)
+    return attributes
 
 
 def _add_or_drop_columns_to_existing_set_table(ns: str, ws: str, etype: str, member_column_name: str) -> None:
@@ -306,10 +582,9 @@ def transfer_set_table(namespace: str,
     logger.info(f"Original set table {original_set_type} fetched")
 
     # format
-    uuids = [e.get('name') for e in response.json()]
-    attributes_table = pd.DataFrame.from_dict([e.get('attributes') for e in response.json()])
-    attributes_table.insert(0, f'entity:{original_set_type}_id', uuids)
-    original_table = attributes_table.copy(deep=True)
+    entities = response.json()
+    original_table = pd.DataFrame.from_records([e.get('attributes') for e in entities])
+    original_table.insert(0, original_set_type, [e.get('name') for e in entities])
 
     ready_for_upload_table, members_list = format_set_table_ready_for_upload(
         original_table, current_set_type_name=original_set_type,
@@ -340,6 +615,367 @@ def transfer_set_table(namespace: str,
             raise
 
 
+def migrate_table(original_namespace: str, original_workspace: str,
+                  new_namespace: str, new_workspace: str,
+                  original_etype: str, desired_new_etype: str,
+                  checkpoint_file: str,
+                  membership_col_name: str = None,
+                  copy_files: bool = True,
+                  page_size: int = ENTITY_PAGE_SIZE,
+                  chunk_size: int = UPLOAD_CHUNK_SIZE) -> None:
+    """
+    Migrate a table (root or set level) from one workspace to another, possibly under a different namespace,
+    together with the files in the original workspace's bucket that the table's attributes point to.
+
+    The original table is streamed page by page. For each page,
+      * gs:// attribute values pointing into the original workspace's bucket are rewritten to point into
+        the new workspace's bucket, and the referenced objects are copied over server-side;
+      * entities (sans membership), then memberships if a set table, are uploaded in chunks.
+    Completed pages are recorded in checkpoint_file, so re-running the same migration after an interruption
+    resumes where it stopped.
+
+    Assuming, for set tables, that all the member entities are already in the target workspace.
+    Note that memberships are added to, not reset, in the target workspace.
+    :param original_namespace:
+    :param original_workspace:
+    :param new_namespace:
+    :param new_workspace:
+    :param original_etype:
+    :param desired_new_etype:
+    :param checkpoint_file: local JSON file recording progress
+    :param membership_col_name: name of the membership column, if migrating a set level table
+    :param copy_files: whether to copy over, and re-point attributes to, files in the original workspace's bucket
+    :param page_size: number of entities fetched per request
+    :param chunk_size: number of rows uploaded per request
+    :return:
+    """
+    migration = {'original': f'{original_namespace}/{original_workspace}/{original_etype}',
+                 'new': f'{new_namespace}/{new_workspace}/{desired_new_etype}',
+                 'page_size': page_size}
+    checkpoint = _load_checkpoint(checkpoint_file, migration)
+    completed_pages = set(checkpoint['completed'])
+
+    original_bucket = _get_workspace_bucket(original_namespace, original_workspace) if copy_files else None
+    new_bucket = _get_workspace_bucket(new_namespace, new_workspace) if copy_files else None
+    member_entity_type = _resolve_member_type(membership_col_name) if membership_col_name else None
+    if copy_files:
+        # only migrations copying files need the storage client, which is slow to import
+        from ..gcs_utils import copy_many
+
+    for page, entities in _iter_entity_pages(original_namespace, original_workspace, original_etype, page_size,
+                                             skip_pages=completed_pages):
+        attributes = [e.get('attributes') for e in entities]
+        if copy_files:
+            attributes, files_to_copy = _repoint_bucket_references(attributes, original_bucket, new_bucket)
+            if files_to_copy:
+                results = copy_many(files_to_copy)
+                if any(results['status'] == 'failed'):
+                    raise RuntimeError(f"Failed to copy some files referenced by page {page} of {original_etype}."
+                                       f" Check the logs, then re-run to resume.")
+
+        names = [e.get('name') for e in entities]
+        members = [a.pop(membership_col_name, None) for a in attributes] if membership_col_name else None
+        table = pd.DataFrame.from_records([{k: format_attribute_for_tsv(v) for k, v in a.items()}
+                                           for a in attributes])
+        table.insert(0, f'entity:{desired_new_etype}_id', names)
+        _upload_entities_in_chunks(new_namespace, new_workspace, table, chunk_size)
+
+        if membership_col_name:
+            membership = pd.DataFrame.from_records(
+                [(n, m['entityName']) for n, d in zip(names, members) if d for m in d['items']],
+                columns=[f'membership:{desired_new_etype}_id', member_entity_type])
+            _upload_entities_in_chunks(new_namespace, new_workspace, membership, chunk_size)
+
+        checkpoint['completed'].append(page)
+        _save_checkpoint(checkpoint_file, checkpoint)
+        logger.info(f"Migrated page {page} ({len(entities)} entities) of {original_etype}.")
+
+
+def _iter_entity_pages(ns: str, ws: str, etype: str, page_size: int, skip_pages: set = None):
+    """
+    Stream the entities of a table, page by page, in a stable (sorted by name) order.
+    :return: generator of (1-based page number, list of entities on that page)
+    """
+    skip_pages = skip_pages or set()
+    page = 1
+    page_count = None  # known after the 1st page is fetched, which is always fetched for that reason
+    while page_count is None or page <= page_count:
+        if page_count is not None and page in skip_pages:
+            page += 1
+            continue
+        response = fapi.get_entities_query(ns, ws, etype, page=page, page_size=page_size)
+        if not response.ok:
+            logger.error(f"Failed to fetch page {page} of table {etype} in workspace {ns}/{ws}.")
+            raise FireCloudServerError(response.status_code, response.text)
+        payload = response.json()
+        page_count = payload['resultMetadata']['filteredPageCount']
+        if page not in skip_pages:
+            yield page, payload['results']
+        page += 1
+
+
+def _get_workspace_bucket(ns: str, ws: str) -> str:
+    response = fapi.get_workspace(ns, ws, fields='workspace.bucketName')
+    if not response.ok:
+        logger.error(f"Failed to get the bucket of workspace {ns}/{ws}.")
+        raise FireCloudServerError(response.status_code, response.text)
+    return response.json()['workspace']['bucketName']
+
+
+def _repoint_bucket_references(attributes: List[dict], original_bucket: str, new_bucket: str) \
+        -> (List[dict], List[Tuple['GcsPath', 'GcsPath']]):
+    """
+    Rewrite gs:// values (including those in value lists) pointing into original_bucket to point into new_bucket.
+    :return: rewritten attributes, and (original, new) pairs of the objects referenced
+    """
+    original_head = f'gs://{original_bucket}/'
+    new_head = f'gs://{new_bucket}/'
+    files_to_copy = dict()
+
+    def _repoint(v):
+        if isinstance(v, str) and v.startswith(original_head):
+            repointed = new_head + v[len(original_head):]
+            files_to_copy[v] = repointed
+            return repointed
+        if isinstance(v, dict) and 'AttributeValue' == v.get('itemsType'):
+            return dict(v, items=[_repoint(i) for i in v['items']])
+        return v
+
+    from ..gcs_utils import GcsPath
+
+    rewritten = [{k: _repoint(v) for k, v in a.items()} for a in attributes]
+    return rewritten, [(GcsPath(o), GcsPath(n)) for o, n in files_to_copy.items()]
+
+
+def format_attribute_for_tsv(v):
+    """
+    Lists and references, as returned by the API in JSON (or as plain python lists),
+    are formatted the way the TSV import understands them.
+    """
+    if isinstance(v, list):
+        return json.dumps(v)
+    if isinstance(v, dict):
+        if 'items' in v:
+            return json.dumps(v['items'])
+        return json.dumps(v)
+    return v
+
+
+def _format_desired_attribute_for_tsv(v):
+    """
+    Same as format_attribute_for_tsv, except that strings holding python literals of dicts or lists
+    (e.g. from fetch_existing_root_table, which casts everything to str) are parsed back first.
+    """
+    if isinstance(v, str) and v[:1] in ('{', '['):
+        try:
+            json.loads(v)
+            return v  # already formatted
+        except ValueError:
+            pass
+        try:
+            literal = ast.literal_eval(v)
+        except (ValueError, SyntaxError):
+            return v
+        if isinstance(literal, (dict, list)):
+            return format_attribute_for_tsv(literal)
+        return v
+    return format_attribute_for_tsv(v)
+
+
+def _upload_entities_in_chunks(ns: str, ws: str, table: pd.DataFrame, chunk_size: int,
+                               delete_empty: bool = False) -> None:
+    """
+    Upload a TSV-ready table (entity or membership) in chunks of rows.
+    :param delete_empty: whether blank cells remove the corresponding attributes, instead of leaving them untouched
+    """
+    for start in range(0, len(table), chunk_size):
+        _upload_one_chunk(ns, ws, table.iloc[start:start + chunk_size], max_retries=UPLOAD_MAX_RETRIES,
+                          delete_empty=delete_empty)
+
+
+########################################################################################################################
+def sync_table(ns: str, ws: str, etype: str, desired_table: pd.DataFrame,
+               membership_col_name: str = None,
+               dry_run: bool = False,
+               chunk_size: int = UPLOAD_CHUNK_SIZE) -> pd.DataFrame:
+    """
+    Make a table on Terra look like desired_table, by issuing only the operations needed,
+    instead of re-uploading the whole table.
+
+    The current table is fetched once and diff'ed against desired_table, by entity ID, cell by cell:
+      * new entities are uploaded in full;
+      * changed attributes are upserted, in chunks, with only the changed rows and columns;
+      * attributes that are empty (NaN) in desired_table but not on Terra are removed, in chunks;
+      * for set tables, members are added/removed so that the membership matches.
+    Columns on Terra but not in desired_table, and entities on Terra but not in desired_table, are left untouched.
+
+    Cells of desired_table are formatted the same way as the values fetched from Terra
+    (see format_attribute_for_tsv), so lists and references may be given as python lists and dicts,
+    as their JSON strings, or as the str(...) of the dicts returned by the API,
+    which is what fetch_existing_root_table holds for them; the latter are parsed back,
+    i.e. a string cell that is the python literal of a dict or list is never uploaded as a plain string.
+    :param ns:
+    :param ws:
+    :param etype: e.g. 'flowcell'
+    :param desired_table: 1st column holds the entity IDs, the other columns the attributes
+    :param membership_col_name: name of the column holding (lists of) members, if a set table
+    :param dry_run: only compute and return the diff, don't change anything on Terra
+    :param chunk_size: number of rows per upsert request
+    :return: the diff, one row per operation, columns ['entity', 'attribute', 'operation', 'current', 'desired']
+    """
+    response = fapi.get_entities(ns, ws, etype=etype)
+    if not response.ok:
+        logger.error(f"Table {etype} doesn't seem to exist in workspace {ns}/{ws}.")
+        raise FireCloudServerError(response.status_code, response.text)
+    entities = response.json()
+
+    current = pd.DataFrame.from_records([{k: format_attribute_for_tsv(v) for k, v in e.get('attributes').items()}
+                                         for e in entities],
+                                        index=pd.Index([e.get('name') for e in entities], dtype=object))
+    desired = desired_table.set_index(desired_table.columns[0])
+    desired.index = desired.index.astype(str)
+
+    current_members = desired_members = None
+    if membership_col_name:
+        current_members = {e.get('name'): [m['entityName'] for m in e['attributes'][membership_col_name]['items']]
+                           for e in entities if membership_col_name in e.get('attributes')}
+        desired_members = desired.pop(membership_col_name)
+        current = current.drop(columns=[membership_col_name], errors='ignore')
+    desired = desired.apply(lambda col: col.map(_format_desired_attribute_for_tsv))
+
+    report = _diff_tables(current, desired, current_members, desired_members)
+    logger.info(f"Syncing table {etype} in workspace {ns}/{ws}:\n{report['operation'].value_counts().to_string()}")
+    if dry_run or report.empty:
+        return report
+
+    _apply_table_diff(ns, ws, etype, desired, desired_members, report, membership_col_name, chunk_size)
+    return report
+
+
+def _diff_tables(current: pd.DataFrame, desired: pd.DataFrame,
+                 current_members: Dict[str, List[str]] or None, desired_members: pd.Series or None) -> pd.DataFrame:
+    columns = ['entity', 'attribute', 'operation', 'current', 'desired']
+
+    new_ids = desired.index.difference(current.index, sort=False)
+    common_ids = desired.index.intersection(current.index, sort=False)
+    records = [(e, None, 'AddEntity', None, None) for e in new_ids]
+
+    # cell by cell, over the entities on both sides, and the columns in the desired table
+    cur = current.reindex(index=common_ids, columns=desired.columns)
+    des = desired.loc[common_ids]
+    cur_na, des_na = cur.isna(), des.isna()
+    differ = pd.DataFrame({c: _canonical_column(cur[c]) != _canonical_column(des[c]) for c in des.columns},
+                          index=des.index)
+    updates = differ & ~des_na
+    removals = des_na & ~cur_na
+    for operation, mask in [('AddUpdateAttribute', updates), ('RemoveAttribute', removals)]:
+        flagged = mask.stack()
+        for e, a in flagged[flagged].index:
+            records.append((e, a, operation, cur.at[e, a], None if 'RemoveAttribute' == operation else des.at[e, a]))
+
+    if desired_members is not None:
+        for e, members in desired_members.items():
+            if not isinstance(members, (list, tuple)):
+                continue
+            existing = set(current_members.get(e, list()))
+            wanted = set(members)
+            records.extend((e, m, 'AddListMember', None, m) for m in members if m not in existing)
+            records.extend((e, m, 'RemoveListMember', m, None) for m in existing - wanted)
+
+    return pd.DataFrame.from_records(records, columns=columns)
+
+
+def _canonical_column(col: pd.Series) -> pd.Series:
+    """
+    Canonical string form of each cell of a column, see _canonical_cell(...);
+    each distinct value is converted only once.
+    """
+    codes, uniques = pd.factorize(col, use_na_sentinel=False)
+    canonical = np.array([_canonical_cell(v) for v in uniques], dtype=object)
+    return pd.Series(canonical[codes], index=col.index)
+
+
+def _canonical_cell(v) -> str:
+    """
+    Canonical string form of an attribute value, so that values Terra stores identically compare equal,
+    whatever dtype pandas happened to infer for their columns,
+    e.g. 5, 5.0 (an int column with missing values) and '5.0' are all '5'; True and 'true' are both 'true';
+    missing values are 'nan'.
+    """
+    if isinstance(v, (bool, np.bool_)):
+        return 'true' if v else 'false'
+    if isinstance(v, (int, np.integer)):
+        return str(int(v))
+    if isinstance(v, str):
+        if v.lower() in ('true', 'false'):
+            return v.lower()
+        try:
+            return str(int(v))
+        except ValueError:
+            pass
+        try:
+            f = float(v)
+        except ValueError:
+            return v
+    elif isinstance(v, (float, np.floating)):
+        f = float(v)
+    else:
+        return 'nan' if v is None or v is pd.NaT else str(v)
+    if f != f:
+        return 'nan'
+    return str(int(f)) if f.is_integer() else repr(f)
+
+
+def _apply_table_diff(ns: str, ws: str, etype: str,
+                      desired: pd.DataFrame, desired_members: pd.Series or None,
+                      report: pd.DataFrame, membership_col_name: str or None, chunk_size: int) -> None:
+    id_col = f'entity:{etype}_id'
+
+    # new entities, in full
+    new_ids = report.loc[report['operation'] == 'AddEntity', 'entity']
+    if 0 < len(new_ids):
+        new_rows = desired.loc[new_ids].rename_axis(id_col).reset_index()
+        _upload_entities_in_chunks(ns, ws, new_rows, chunk_size)
+
+    # changed attributes, as a sparse table: blank cells are left untouched by the upsert
+    updates = report[report['operation'] == 'AddUpdateAttribute']
+    if 0 < len(updates):
+        changed = updates.pivot(index='entity', columns='attribute', values='desired')
+        _upload_entities_in_chunks(ns, ws, changed.rename_axis(id_col).reset_index().rename_axis(None, axis=1),
+                                   chunk_size)
+
+    # members to add
+    additions = report[report['operation'] == 'AddListMember']
+    if 0 < len(additions):
+        member_type = _resolve_member_type(membership_col_name)
+        membership = pd.DataFrame({f'membership:{etype}_id': additions['entity'].values,
+                                   member_type: additions['desired'].values})
+        _upload_entities_in_chunks(ns, ws, membership, chunk_size)
+
+    # removed attributes, as tables of blank cells uploaded with delete_empty;
+    # since every blank cell is deleted, entities are grouped by the exact set of attributes they lose,
+    # e.g. a column cleared across all rows is a single table
+    removals = report[report['operation'] == 'RemoveAttribute']
+    if 0 < len(removals):
+        removed = removals.groupby('entity', sort=False)['attribute'].agg(lambda a: tuple(sorted(a)))
+        for attributes, entities in removed.groupby(removed, sort=False):
+            blanks = pd.DataFrame({id_col: entities.index, **{a: '' for a in attributes}})
+            _upload_entities_in_chunks(ns, ws, blanks, chunk_size, delete_empty=True)
+
+    # members to remove, entity by entity, as the TSV import can only add members
+    member_removals = report[report['operation'] == 'RemoveListMember']
+    for e, rows in member_removals.groupby('entity', sort=False):
+        operations = [{"op": "RemoveListMember",
+                       "attributeListName": membership_col_name,
+                       "removeMember": {"entityType": _resolve_member_type(membership_col_name),
+                                        "entityName": m}}
+                      for m in rows['attribute']]
+        response = fapi.update_entity(ns, ws, etype=etype, ename=e, updates=operations)
+        if not response.ok:
+            logger.error(f"Failed to remove members {rows['attribute'].tolist()} from {etype} {e}.")
+            raise FireCloudServerError(response.status_code, response.text)
+
+
 ########################################################################################################################
 def new_or_overwrite_attribute(ns: str, ws: str, etype: str, ename: str,
                                attribute_name: str, attribute_value,
@@ -470,7 +1106,7 @@ def update_one_list_attribute(ns: str, ws: str,
             "attributeListName": attribute_name,
             "newMember": val
         })
-        logger.debug(operations)
+    logger.debug(operations)
 
     response = fapi.update_entity(ns, ws,
                                   etype=etype,
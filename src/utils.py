@@ -1,9 +1,17 @@
+import datetime
+import functools
 import logging
 import os
-from typing import List
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Iterable, List
 
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail, From, To, Subject, PlainTextContent, HtmlContent
+# heavier dependencies (dateutil, sendgrid) are imported only by the functions needing them,
+# as this module is imported by every other module of the package
+if TYPE_CHECKING:
+    from sendgrid import SendGridAPIClient
 
 ########################################################################################################################
 logger = logging.getLogger(__name__)
@@ -39,18 +47,94 @@ def absolute_file_paths(directory):
             yield os.path.abspath(os.path.join(dir_path, f))
 
 
+########################################################################################################################
+# Cromwell and Terra both report time in a fixed ISO-8601 flavor, e.g. '2021-06-01T12:34:56.789Z'.
+# Generic dateutil parsing is slow when done for every workflow/attempt, so we parse that flavor directly,
+# memoize repeated strings (many attempts/workflows share timestamps), and only fall back to dateutil otherwise.
+ISO_TIMESTAMP_PATTERN = re.compile(r'^(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,9}))?'
+                                   r'(Z|[+-]\d{2}:?\d{2})?$')
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_iso_timestamp(timestamp: str) -> datetime.datetime:
+    """
+    Parse a Cromwell/Terra ISO-8601 timestamp string into a datetime.
+
+    Timezone-aware if, and only if, the string carries an offset (or 'Z'), same as dateutil.
+    :param timestamp: e.g. '2021-06-01T12:34:56.789Z'
+    :return: parsed datetime
+    """
+    m = ISO_TIMESTAMP_PATTERN.match(timestamp)
+    if m is not None:
+        year, month, day, hour, minute, second, fraction, offset = m.groups()
+        microsecond = int(fraction[:6].ljust(6, '0')) if fraction else 0
+        try:
+            if offset is None:
+                tz = None
+            elif 'Z' == offset:
+                tz = datetime.timezone.utc
+            else:
+                sign = -1 if offset.startswith('-') else 1
+                digits = offset[1:].replace(':', '')
+                tz = datetime.timezone(sign * datetime.timedelta(hours=int(digits[:2]), minutes=int(digits[2:])))
+            return datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second),
+                                     microsecond, tzinfo=tz)
+        except ValueError:  # well-formed but out of datetime's range, e.g. '24:00:00', which ISO-8601 allows
+            pass
+
+    from dateutil import parser
+    try:
+        return parser.isoparse(timestamp)
+    except ValueError:
+        return parser.parse(timestamp)
+
+
+def parse_iso_timestamps(timestamps: Iterable[str]) -> List[datetime.datetime]:
+    """
+    Batch version of parse_iso_timestamp, for converting a whole column of timestamps at once.
+
+    Each distinct string is parsed only once.
+    :param timestamps: e.g. a list, or a pandas Series, of timestamp strings
+    :return: parsed datetimes, in the same order as the input
+    """
+    timestamps = list(timestamps)
+    parsed = {s: parse_iso_timestamp(s) for s in set(timestamps)}
+    return [parsed[s] for s in timestamps]
+
+
+########################################################################################################################
+NOTIFICATION_BATCH_SIZE = 1000  # SendGrid accepts at most this many personalizations (here, recipients) per request
+NOTIFICATION_MAX_RETRIES = 3  # number of times a batch is retried when rate-limited (429) or on server errors (5xx)
+
+_notification_executor = None
+_notification_executor_lock = threading.Lock()
+
+
 def send_notification(notification_sender_name: str,
                       notification_receiver_names: List[str], notification_receiver_emails: List[str],
                       email_subject: str, email_body: str,
-                      html_body: str = None) -> None:
+                      html_body: str = None,
+                      batch_size: int = NOTIFICATION_BATCH_SIZE,
+                      max_workers: int = 4,
+                      max_retries: int = NOTIFICATION_MAX_RETRIES,
+                      wait: bool = True) -> Future or None:
     """
     Sending notification email to (potentially) multiple recipients.
 
+    Recipients are sent to in batches, one request per batch, where each recipient gets its own copy
+    (i.e. doesn't see the other recipients); batches are sent concurrently,
+    and retried when rate-limited (429) or on server errors (5xx).
+
     Provide html_body at your own risk.
 
     Shameless copy from
     https://github.com/sendgrid/sendgrid-python/blob/main/examples/helpers/mail_example.py#L9
-    :return:
+    :param batch_size: number of recipients per request
+    :param max_workers: number of batches sent concurrently
+    :param max_retries: number of times a batch is retried
+    :param wait: if False, return immediately, and send the emails in the background
+                 (they are still sent before the interpreter exits)
+    :return: None, or if not waiting, a Future that completes when all emails are sent (or given up on)
     """
 
     assert "SENDGRID_API_KEY" in os.environ, \
@@ -61,19 +145,75 @@ def send_notification(notification_sender_name: str,
     if len(notification_receiver_emails) != len(notification_receiver_names):
         raise ValueError("Different number of recipients and recipients' emails")
 
+    from sendgrid import SendGridAPIClient
+    from sendgrid.helpers.mail import Mail, From, To, Subject, PlainTextContent, HtmlContent
+
     sg = SendGridAPIClient(api_key=os.environ.get('SENDGRID_API_KEY'))
     notification_sender_email = os.environ.get('SENDER_EMAIL')
-    failed_responses = list()
-    for i in range(len(notification_receiver_emails)):
-        message = Mail(from_email=From(notification_sender_email, notification_sender_name),
-                       to_emails=To(notification_receiver_emails[i], notification_receiver_names[i]),
-                       subject=Subject(email_subject),
-                       plain_text_content=PlainTextContent(email_body),
-                       html_content=HtmlContent(html_body) if html_body else None)
-        response = sg.client.mail.send.post(request_body=message.get())
-        if 202 != response.status_code:
-            failed_responses.append(i)
-    if 0 < len(failed_responses):
-        failures = '\n'.join([notification_receiver_names[i]+':'+notification_receiver_emails[i]
-                              for i in failed_responses])
-        logger.warning(f"Failed to send message to some receivers: {failures}")
+    batches = [range(start, min(start + batch_size, len(notification_receiver_emails)))
+               for start in range(0, len(notification_receiver_emails), batch_size)]
+
+    def _send_all() -> None:
+        failed_responses = list()
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = list()
+            for batch in batches:
+                message = Mail(from_email=From(notification_sender_email, notification_sender_name),
+                               to_emails=[To(notification_receiver_emails[i], notification_receiver_names[i])
+                                          for i in batch],
+                               subject=Subject(email_subject),
+                               plain_text_content=PlainTextContent(email_body),
+                               html_content=HtmlContent(html_body) if html_body else None,
+                               is_multiple=True)
+                futures.append((batch, pool.submit(_send_one_notification_batch, sg, message.get(), max_retries)))
+            for batch, future in futures:
+                if not future.result():
+                    failed_responses.extend(batch)
+        if 0 < len(failed_responses):
+            failures = '\n'.join([notification_receiver_names[i]+':'+notification_receiver_emails[i]
+                                  for i in failed_responses])
+            logger.warning(f"Failed to send message to some receivers: {failures}")
+
+    if wait:
+        _send_all()
+        return None
+    return _get_notification_executor().submit(_send_all)
+
+
+def _send_one_notification_batch(sg: 'SendGridAPIClient', request_body: dict, max_retries: int) -> bool:
+    """
+    :return: whether the batch is accepted by SendGrid
+    """
+    from python_http_client.exceptions import HTTPError
+
+    for attempt in range(1 + max_retries):
+        retry_after = None
+        try:
+            response = sg.client.mail.send.post(request_body=request_body)
+            status_code = response.status_code
+        except HTTPError as e:  # raised by the client for 4xx/5xx responses
+            status_code = e.status_code
+            retry_after = e.headers.get('Retry-After') if e.headers else None
+        except OSError as e:  # connection level failures, worth retrying too
+            logger.warning(f"Failed to reach SendGrid: {e}")
+            status_code = None
+
+        if 202 == status_code:
+            return True
+        if status_code is not None and 429 != status_code and status_code < 500:
+            logger.warning(f"SendGrid rejected a batch of notifications with status {status_code}.")
+            return False
+        if attempt < max_retries:
+            time.sleep(int(retry_after) if retry_after and retry_after.isdigit() else 2 ** attempt)
+    return False
+
+
+def _get_notification_executor() -> ThreadPoolExecutor:
+    """
+    The (lazily started) single background thread that notifications are sent from, when not waiting on them.
+    """
+    global _notification_executor
+    with _notification_executor_lock:
+        if _notification_executor is None:
+            _notification_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='notification')
+        return _notification_executor